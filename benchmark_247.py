@@ -0,0 +1,209 @@
+import re
+import time
+import argparse
+import numpy as np
+import pandas as pd
+import xml.etree.ElementTree as ET
+from classes.ecog import Ecog
+from classes.audio import Audio
+from classes.transcript import Transcript
+
+
+def time_call(fun, *args, repeats=1, **kwargs):
+    """Best wall-clock time of a function call, in seconds."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fun(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+
+def bench_read_channels(edf_file, onset_sec, offset_sec, processes, chan_slice):
+    """Compare thread and process-pool channel reading on one EDF file."""
+    ecog_file = Ecog("bench", edf_file)
+    ecog_file.read_EDFHeader()
+
+    if offset_sec is None:
+        offset_sec = int(ecog_file.ecog_hdr["Duration"])
+
+    thread_sec = time_call(ecog_file.read_channels, onset_sec, offset_sec)
+    thread_data = ecog_file.data
+    mb = thread_data.nbytes / 1e6
+    print(f"threads: {thread_sec:.2f} s ({mb / thread_sec:.0f} MB/s)")
+
+    process_sec = time_call(
+        ecog_file.read_channels,
+        onset_sec,
+        offset_sec,
+        processes=processes,
+        chan_slice=chan_slice,
+    )
+    print(f"processes ({processes}): {process_sec:.2f} s ({mb / process_sec:.0f} MB/s)")
+    print(f"same output: {np.array_equal(thread_data, ecog_file.data)}")
+
+
+def slow_pydub(track, speed):
+    """Previous slow-down: relabel the frame rate, then convert it back with pydub."""
+    return track._spawn(
+        track.raw_data, overrides={"frame_rate": int(track.frame_rate * speed)}
+    ).set_frame_rate(track.frame_rate)
+
+
+def slow_blocks(audio_file, track, speed, block_sec):
+    """Block-wise polyphase slow-down, as in Audio.stream_audio."""
+    resampler = audio_file.slow_resampler(speed)
+    block_len = int(block_sec * track.frame_rate) * track.frame_width
+    data = track.raw_data
+    out = []
+    for start in range(0, len(data), block_len):
+        samples = audio_file.pcm_to_array(
+            data[start : start + block_len], track.sample_width, track.channels
+        )
+        out.append(
+            audio_file.array_to_pcm(resampler.process(samples), track.sample_width)
+        )
+    out.append(audio_file.array_to_pcm(resampler.flush(), track.sample_width))
+
+    return b"".join(out)
+
+
+def bench_slow_audio(wav_file, speed, block_sec):
+    """Compare the pydub and polyphase slow-downs on one WAV file."""
+    audio_file = Audio("bench", wav_file)
+    audio_file.read_audio()
+    track = audio_file.audio_track
+    audio_sec = track.frame_count() / track.frame_rate
+    print(f"input: {audio_sec:.0f} s, expected output: {audio_sec / speed:.2f} s")
+
+    def report(name, seconds, out_bytes):
+        out_sec = out_bytes / track.frame_width / track.frame_rate
+        print(
+            f"{name}: {seconds:.2f} s ({audio_sec / seconds:.0f}x real time), "
+            f"output {out_sec:.2f} s"
+        )
+
+    pydub_sec = time_call(slow_pydub, track, speed)
+    report("pydub", pydub_sec, len(slow_pydub(track, speed).raw_data))
+
+    audio_file.transcribe_audio = track
+    poly_sec = time_call(audio_file.slow_audio, speed)
+    report("polyphase", poly_sec, len(audio_file.transcribe_audio.raw_data))
+
+    block_sec_taken = time_call(slow_blocks, audio_file, track, speed, block_sec)
+    block_out = slow_blocks(audio_file, track, speed, block_sec)
+    report(f"polyphase ({block_sec} s blocks)", block_sec_taken, len(block_out))
+    print(f"same output in blocks: {block_out == audio_file.transcribe_audio.raw_data}")
+
+
+def tokenize_loop(texts):
+    """Previous tokenization: one line, element and token at a time."""
+    punc = "([. |, |! |?])"
+    token_types = []
+    tokens = []
+    lines = []
+    speakers = []
+    utterance_idxs = []
+    utterance_idx = -1
+    speaker = "Unknown"
+    for line_idx, text in enumerate(texts):
+        if "[" in text:
+            start_idx = text.index("[")
+            end_idx = text.index("]") + 1
+            text = (
+                text[:start_idx]
+                + text[start_idx:end_idx].replace(" ", "")
+                + text[end_idx:]
+            )
+        line = text.split(" ")
+        if line[0] == ">>":
+            utterance_idx += 1
+            del line[0]
+            label_break = [idx for idx, s in enumerate(line) if ":" in s]
+            if label_break:
+                speaker = "".join(line[: label_break[0] + 1]).replace(":", "")
+                del line[: label_break[0] + 1]
+        speakers.append(speaker)
+        utterance_idxs.append(utterance_idx)
+        for elem in line:
+            elem_tokens = re.split(punc, elem)
+            for token in elem_tokens:
+                if "[" in token:
+                    token_type = "tag"
+                elif token in punc:
+                    token_type = "punctuation"
+                    del elem_tokens[-1]
+                else:
+                    token_type = "word"
+                token_types.append(token_type)
+                tokens.append(token)
+                lines.append(line_idx)
+
+    return (
+        pd.DataFrame({"speaker": speakers, "utterance_idx": utterance_idxs}),
+        pd.DataFrame({"line": lines, "token": tokens, "token_type": token_types}),
+    )
+
+
+def bench_tokenize(xml_file, repeats):
+    """Compare the loop and vectorized tokenizers on the lines of one transcript."""
+    ns = "{http://www.w3.org/2006/10/ttaf1}"
+    texts = [
+        elem.text
+        for _, elem in ET.iterparse(xml_file)
+        if elem.tag == ns + "p" and elem.text is not None
+    ]
+    texts = pd.Series(texts, dtype=object)
+
+    loop_sec = time_call(tokenize_loop, texts, repeats=repeats)
+    vector_sec = time_call(Transcript.tokenize, texts, repeats=repeats)
+    loop_lines, loop_tokens = tokenize_loop(texts)
+    lines, tokens = Transcript.tokenize(texts)
+
+    print(f"{len(texts)} lines, {len(tokens)} tokens")
+    print(f"loop: {loop_sec:.2f} s ({len(loop_tokens) / loop_sec:.0f} tokens/s)")
+    print(f"vectorized: {vector_sec:.2f} s ({len(tokens) / vector_sec:.0f} tokens/s)")
+    same = loop_lines.equals(lines.astype({"speaker": object})) and loop_tokens.equals(
+        tokens.astype({"token_type": object})
+    )
+    print(f"same output: {same}")
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--bench",
+        choices=["read_channels", "slow_audio", "tokenize"],
+        default="read_channels",
+    )
+    parser.add_argument("--edf", type=str)
+    parser.add_argument("--wav", type=str)
+    parser.add_argument("--xml", type=str)
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument("--speed", type=float, default=0.95)
+    parser.add_argument("--block_sec", type=float, default=60)
+    parser.add_argument("--onset", type=int, default=0)
+    parser.add_argument("--offset", type=int, default=None)
+    parser.add_argument("--processes", type=int, default=8)
+    parser.add_argument("--chan_slice", type=int, default=16)
+
+    return parser.parse_args()
+
+
+def main():
+    args = arg_parse()
+    if args.bench == "slow_audio":
+        bench_slow_audio(args.wav, args.speed, args.block_sec)
+        return
+    if args.bench == "tokenize":
+        bench_tokenize(args.xml, args.repeats)
+        return
+
+    bench_read_channels(
+        args.edf, args.onset, args.offset, args.processes, args.chan_slice
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,7 @@ import plotly.graph_objects as go
 import numpy as np
 from pathlib import Path
 from classes.ecog import Ecog
+from classes.edf import EdfHeaderIndex
 from scipy.io import loadmat
 
 class Plots:
@@ -263,7 +264,11 @@ class Plots:
         # Validate electrode naming (format to electrode names from EDF header)
         # TODO: Verify electrode name consistency across EDF files
         ecog_file = Ecog(self.sid, str(self.filenames["ecog-raw"]).format(sid=self.sid,part="001"))
-        ecog_file.read_EDFHeader()
+        header_index = EdfHeaderIndex(
+            str(self.filenames["edf-index"]).format(sid=self.sid)
+        )
+        ecog_file.read_EDFHeader(header_index)
+        header_index.save()
         valid_names = ecog_file.ecog_hdr["channels"]
 
         #grp, num, *junk = re.split('(\d+)',elec)
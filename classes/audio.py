@@ -1,8 +1,14 @@
+import wave
 import taglib
 import getpass
 import numpy as np
+from fractions import Fraction
 from pydub import AudioSegment
 from autologging import traced, logged
+from classes.dsp import Resampler, SpectralGate
+
+# Sample type of each PCM sample width
+PCM_DTYPES = {1: "u1", 2: "<i2", 4: "<i4"}
 
 
 @traced
@@ -20,6 +26,8 @@ class Audio:
         audio_transcribe_path: Subject transcription audio directory, DType: PosixPath.
         deid_audio: Data from de-identified audio file (input audio), DType: Pydub AudioSegment.
         transcribe_audio: Audio data for transcription (output audio), DType: Pydub AudioSegment.
+        samp_rate: Sampling rate from the WAV header, DType: int.
+        n_frames: Number of frames from the WAV header, DType: int.
     """
 
     def __init__(self, sid: str, file):
@@ -44,14 +52,112 @@ class Audio:
         # play(audioPart)
         # NOTE: pydub does things in milliseconds
 
-    def crop_audio(self, silence_times):
-        """Remove marked segments from audio. For uploading for transcription."""
-        # TODO: The deid audio files might be split parts
-        # TODO: Do more checks
+    def read_wav_info(self):
+        """Read sampling rate, sample width and length from the WAV header."""
+        with wave.open(str(self.in_name), "rb") as wav_file:
+            self.samp_rate = wav_file.getframerate()
+            self.n_channels = wav_file.getnchannels()
+            self.samp_width = wav_file.getsampwidth()
+            self.n_frames = wav_file.getnframes()
+
+    def read_blocks(self, onset_sec=0, offset_sec=None, block_sec=60):
+        """Read the WAV file in fixed-duration mono blocks, without pydub.
+
+        Only one block is held in memory at a time.
+
+        Args:
+            onset_sec (float): Beginning of time frame to read.
+            offset_sec (float, optional): End of time frame, defaults to the end.
+            block_sec (float): Duration of each block.
+
+        Returns:
+            generator: Yields (sample offset from `onset_sec`, block) pairs,
+                where each block is a 1-D float64 NumPy array in [-1, 1).
+        """
+        self.read_wav_info()
+        onset = int(onset_sec * self.samp_rate)
+        offset = self.n_frames
+        if offset_sec is not None:
+            offset = min(offset, int(offset_sec * self.samp_rate))
+        block_len = int(block_sec * self.samp_rate)
+
+        return self._iter_wav_blocks(str(self.in_name), onset, offset, block_len)
 
-        # Get speech times from silence times
-        # extract sid and part
-        # format
+    def _iter_wav_blocks(self, filename, onset, offset, block_len):
+        """Decode frames onset to offset, block_len frames at a time."""
+        scale = 2.0 ** (8 * self.samp_width - 1)
+
+        with wave.open(filename, "rb") as wav_file:
+            wav_file.setpos(onset)
+            for start in range(onset, offset, block_len):
+                num_frames = min(block_len, offset - start)
+                frames = self.pcm_to_array(
+                    wav_file.readframes(num_frames), self.samp_width, self.n_channels
+                )
+                yield start - onset, frames.mean(axis=1) / scale
+
+    @staticmethod
+    def pcm_to_array(data, samp_width, n_channels):
+        """Decode PCM frames.
+
+        Args:
+            data (bytes): Interleaved PCM frames.
+            samp_width (int): Bytes per sample, 1, 2 or 4.
+            n_channels (int): Number of channels.
+
+        Returns:
+            NumPy array: (frames x channels) float64 sample values, centered on 0.
+        """
+        # 8-bit WAV is unsigned, wider samples are signed little-endian
+        samples = np.frombuffer(data, dtype=PCM_DTYPES[samp_width])
+        samples = samples.reshape(-1, n_channels).astype(np.float64)
+        if samp_width == 1:
+            samples -= 128
+
+        return samples
+
+    @staticmethod
+    def array_to_pcm(samples, samp_width):
+        """Encode sample values as PCM frames, rounded and clipped to the sample width.
+
+        Args:
+            samples (NumPy array): (frames x channels) sample values, centered on 0.
+            samp_width (int): Bytes per sample, 1, 2 or 4.
+
+        Returns:
+            bytes: Interleaved PCM frames.
+        """
+        bound = 2 ** (8 * samp_width - 1)
+        samples = np.clip(np.rint(samples), -bound, bound - 1)
+        if samp_width == 1:
+            samples += 128
+
+        return samples.astype(PCM_DTYPES[samp_width]).tobytes()
+
+    @staticmethod
+    def slow_resampler(speed):
+        """Resampler that slows audio down to speed, keeping its sampling rate.
+
+        Args:
+            speed (float): Playback speed, e.g. 0.95 resamples by 20/19.
+
+        Returns:
+            Resampler: Polyphase resampler by 1 / speed.
+        """
+        ratio = Fraction(speed).limit_denominator(1000)
+
+        return Resampler(ratio.denominator, ratio.numerator)
+
+    @staticmethod
+    def speech_times(silence_times):
+        """Speech intervals between marked silences.
+
+        Args:
+            silence_times (Silence): Silence onsets and offsets.
+
+        Returns:
+            tuple: Onsets and offsets of speech in milliseconds, NumPy arrays.
+        """
         speech_onsets = np.array(
             silence_times.silence_offsets.view(np.int64) / int(1e6)
         )
@@ -61,29 +167,214 @@ class Audio:
 
         # Remove consecutive non-speech labels
         speech_idxs = np.where((speech_offsets - speech_onsets) != 0)
-        speech_times = zip(speech_onsets[speech_idxs], speech_offsets[speech_idxs])
-        # Concat segments
-        crop_audio = AudioSegment.empty()
-        for time in speech_times:
-            crop_audio += self.audio_track[time[0] : time[1]]
-        self.transcribe_audio = crop_audio
 
-    def slow_audio(self):
-        """Slow down audio for transcription."""
+        return speech_onsets[speech_idxs], speech_offsets[speech_idxs]
 
-        # slow_speed = 0.95
+    def speech_frames(self, silence_times, n_frames, frame_rate):
+        """Frame bounds of speech, as pydub slices them: clamped, then truncated.
+
+        Args:
+            silence_times (Silence): Silence onsets and offsets.
+            n_frames (int): Number of frames in the audio.
+            frame_rate (int): Sampling rate of the audio.
+
+        Returns:
+            tuple: First and one-past-last frame of each speech interval,
+                NumPy arrays. Intervals may extend past the last frame.
+        """
+        speech_onsets, speech_offsets = self.speech_times(silence_times)
+
+        len_ms = round(1000 * n_frames / frame_rate)
+        ms_frames = frame_rate / 1000.0
+        starts = (np.minimum(speech_onsets, len_ms) * ms_frames).astype(np.int64)
+        ends = (np.minimum(speech_offsets, len_ms) * ms_frames).astype(np.int64)
+
+        return starts, np.maximum(ends, starts)
+
+    def silence_frames(self, silence_times, n_frames, frame_rate):
+        """Frame bounds of the marked silences, clamped to the audio.
+
+        Args:
+            silence_times (Silence): Silence onsets and offsets.
+            n_frames (int): Number of frames in the audio.
+            frame_rate (int): Sampling rate of the audio.
+
+        Returns:
+            tuple: First and one-past-last frame of each silence, NumPy arrays.
+        """
+        onsets = np.array(silence_times.silence_onsets.view(np.int64)) / 1e9
+        offsets = np.array(silence_times.silence_offsets.view(np.int64)) / 1e9
+        starts = np.clip((onsets * frame_rate).astype(np.int64), 0, n_frames)
+        ends = np.clip((offsets * frame_rate).astype(np.int64), 0, n_frames)
+
+        return starts, np.maximum(ends, starts)
+
+    def noise_gate(self, silence_times, noise_sec=120, block_sec=60, **gate):
+        """Spectral gate with its noise profile read from the marked silences.
+
+        Only the silent frames are read, block by block. When silences add up to
+        more than noise_sec, every n-th one is used, so the profile spans the
+        whole file.
+
+        Args:
+            silence_times (Silence): Silence onsets and offsets.
+            noise_sec (float): Most silence used for the noise profile.
+            block_sec (float): Duration of audio held in memory.
+            **gate: Keyword arguments of `SpectralGate`.
+
+        Returns:
+            SpectralGate: Gate ready to denoise this audio.
+        """
+        self.read_wav_info()
+        block_len = int(block_sec * self.samp_rate)
+        starts, ends = self.silence_frames(silence_times, self.n_frames, self.samp_rate)
+        total = (ends - starts).sum()
+        if total > noise_sec * self.samp_rate:
+            step = int(np.ceil(total / (noise_sec * self.samp_rate)))
+            starts, ends = starts[::step], ends[::step]
+
+        noise_gate = SpectralGate(self.samp_rate, **gate)
+        with wave.open(str(self.in_name), "rb") as in_file:
+            for start, end in zip(starts, ends):
+                in_file.setpos(start)
+                for pos in range(start, end, block_len):
+                    data = in_file.readframes(min(block_len, end - pos))
+                    noise_gate.add_noise(
+                        self.pcm_to_array(data, self.samp_width, self.n_channels)
+                    )
+
+        return noise_gate
+
+    def denoise_audio(self, silence_times, **gate):
+        """Denoise audio for transcription by spectral gating.
+
+        The noise profile comes from the marked silences of the input file
+        (see `noise_gate`).
+
+        Args:
+            silence_times (Silence): Silence onsets and offsets.
+            **gate: Keyword arguments of `SpectralGate`.
+        """
+        noise_gate = self.noise_gate(silence_times, **gate)
+        track = self.transcribe_audio
+        samples = self.pcm_to_array(track.raw_data, track.sample_width, track.channels)
+        clean = np.concatenate([noise_gate.process(samples), noise_gate.flush()])
+
+        self.transcribe_audio = track._spawn(
+            self.array_to_pcm(clean, track.sample_width)
+        )
+
+    def crop_audio(self, silence_times):
+        """Remove marked segments from audio. For uploading for transcription."""
+        # TODO: The deid audio files might be split parts
+        # TODO: Do more checks
+
+        # Frames of the decoded track, one row per frame
+        track = self.audio_track
+        frames = np.frombuffer(track.raw_data, dtype=np.uint8).reshape(
+            -1, track.frame_width
+        )
+        starts, ends = self.speech_frames(silence_times, len(frames), track.frame_rate)
+        lengths = ends - starts
+
+        # Gather every kept frame with one index, frames past the end are silent
+        out_starts = np.cumsum(lengths) - lengths
+        idxs = np.arange(lengths.sum()) + np.repeat(starts - out_starts, lengths)
+        crop_frames = np.zeros((len(idxs), track.frame_width), dtype=np.uint8)
+        in_track = idxs < len(frames)
+        crop_frames[in_track] = frames[idxs[in_track]]
+
+        self.transcribe_audio = track._spawn(crop_frames.tobytes())
+
+    def slow_audio(self, speed=0.95):
+        """Slow down audio for transcription.
+
+        Resamples by 1 / speed with a polyphase filter and keeps the frame
+        rate, so pitch drops along with speed (see `slow_resampler`).
+
+        Args:
+            speed (float): Playback speed of the output.
+        """
         # y_slow = librosa.effects.time_stretch(y, rate=slow_speed)
-        sfaud = self.transcribe_audio._spawn(
-            self.transcribe_audio.raw_data,
-            overrides={"frame_rate": int(self.transcribe_audio.frame_rate * 0.95)},
-        ).set_frame_rate(self.transcribe_audio.frame_rate)
-        # sfaud = sound_with_altered_frame_rate.set_frame_rate(self.audioTrack.frame_rate)
-        # breakpoint()
-        self.transcribe_audio = sfaud
+        track = self.transcribe_audio
+        resampler = self.slow_resampler(speed)
+        samples = self.pcm_to_array(track.raw_data, track.sample_width, track.channels)
+        slow = np.concatenate([resampler.process(samples), resampler.flush()])
+
+        self.transcribe_audio = track._spawn(
+            self.array_to_pcm(slow, track.sample_width)
+        )
 
     def write_audio(self):
         """Write audio signal."""
         self.transcribe_audio.export(self.out_name, format="wav")
-        with taglib.File(self.out_name, save_on_exit=True) as audio_file:
+        self.write_tags()
+
+    def write_tags(self):
+        """Tag the output file with its date-times."""
+        with taglib.File(str(self.out_name), save_on_exit=True) as audio_file:
             audio_file.tags["startDateTime"] = "startDateTime"
             audio_file.tags["endDateTime"] = "endDateTime"
+
+    def stream_audio(self, silence_times, speed=0.95, block_sec=60, denoise=False):
+        """Crop, slow down and write audio for transcription in one pass.
+
+        Streams the WAV file with the stdlib wave module instead of decoding it
+        with pydub. Speech frames are read block by block, optionally denoised,
+        slowed down and written to `out_name` as they go, so memory does not
+        grow with the length of the file. The output matches `crop_audio`,
+        `denoise_audio`, `slow_audio` and `write_audio`, up to rounding.
+
+        Args:
+            silence_times (Silence): Silence onsets and offsets.
+            speed (float): Playback speed of the output.
+            block_sec (float): Duration of audio held in memory.
+            denoise (bool): Spectral gating with a noise profile from the silences.
+        """
+        self.read_wav_info()
+        frame_width = self.n_channels * self.samp_width
+        block_len = int(block_sec * self.samp_rate)
+        starts, ends = self.speech_frames(silence_times, self.n_frames, self.samp_rate)
+
+        # The gate and resampler carry their state from one block to the next
+        resampler = self.slow_resampler(speed)
+        noise_gate = None
+        if denoise:
+            noise_gate = self.noise_gate(silence_times, block_sec=block_sec)
+
+        def write_samples(samples):
+            samples = resampler.process(samples)
+            out_file.writeframes(self.array_to_pcm(samples, self.samp_width))
+
+        def write_block(data):
+            samples = self.pcm_to_array(data, self.samp_width, self.n_channels)
+            if noise_gate is not None:
+                samples = noise_gate.process(samples)
+            write_samples(samples)
+
+        with wave.open(str(self.in_name), "rb") as in_file, wave.open(
+            str(self.out_name), "wb"
+        ) as out_file:
+            out_file.setnchannels(self.n_channels)
+            out_file.setsampwidth(self.samp_width)
+            out_file.setframerate(self.samp_rate)
+
+            block = bytearray()
+            for start, end in zip(starts, ends):
+                in_file.setpos(min(start, self.n_frames))
+                for pos in range(start, end, block_len):
+                    num_frames = min(block_len, end - pos)
+                    data = in_file.readframes(num_frames)
+                    # Frames past the end are silent
+                    block += data + bytes(num_frames * frame_width - len(data))
+
+                    if len(block) >= block_len * frame_width:
+                        write_block(bytes(block))
+                        block = bytearray()
+
+            write_block(bytes(block))
+            if noise_gate is not None:
+                write_samples(noise_gate.flush())
+            out_file.writeframes(self.array_to_pcm(resampler.flush(), self.samp_width))
+
+        self.write_tags()
@@ -0,0 +1,78 @@
+import json
+from pathlib import Path
+from autologging import traced, logged
+
+
+@traced
+@logged
+class ResultCache:
+    """Results of expensive per-file computations, cached in a JSON file.
+
+    Entries are keyed by a fingerprint of the input files (path, size and
+    modification time) and of the parameters, so changing any input or
+    parameter misses the cache.
+
+    ...
+
+    Attributes:
+        file (PosixPath): Path to the cache file.
+        entries (dict): Result of each fingerprint.
+    """
+
+    def __init__(self, file):
+        """Initializes the instance, loading the cache file if it exists.
+
+        Args:
+            file (PosixPath): Path to the cache file.
+        """
+        self.file = Path(file)
+        self.entries = {}
+        self.changed = False
+
+        if self.file.is_file():
+            self.load()
+
+    def load(self):
+        """Read the cache file."""
+        with open(self.file, "r") as f:
+            self.entries = json.load(f)
+
+    def save(self):
+        """Write the cache file, if any entry was added."""
+        if not self.changed:
+            return
+
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.file.with_suffix(".tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(self.entries, f, default=str)
+        tmp_file.replace(self.file)
+        self.changed = False
+
+    @staticmethod
+    def fingerprint(files, **params) -> str:
+        """Key of a computation on files with params.
+
+        Args:
+            files (:obj:`list` of PosixPath): Input files.
+            **params: Parameters of the computation, JSON serializable.
+
+        Returns:
+            str: Cache key.
+        """
+        stats = []
+        for file in files:
+            file = Path(file).resolve()
+            stat = file.stat()
+            stats.append([str(file), stat.st_size, stat.st_mtime_ns])
+
+        return json.dumps([stats, params], sort_keys=True, default=str)
+
+    def get(self, key):
+        """Cached result of a fingerprint, None if missing."""
+        return self.entries.get(key)
+
+    def put(self, key, result):
+        """Cache the result of a fingerprint."""
+        self.entries[key] = result
+        self.changed = True
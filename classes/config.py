@@ -21,8 +21,22 @@ class Config:
             nargs="*",
             default=["subject_prep", "ecog_prep", "audio_prep", "transcript_prep"],
         )
+        parser.add_argument("--workers", type=int, default=None)
+        parser.add_argument("--mem_budget", type=float, default=None)
+        parser.add_argument("--seg_sec", type=int, default=None)
+        parser.add_argument("--split_audio", action="store_true")
+        parser.add_argument("--chan_groups", nargs="*", default=None)
+        parser.add_argument("--exclude_non_electrode", action="store_true")
+        parser.add_argument("--regions", nargs="*", default=None)
+        parser.add_argument("--ref_chan", type=str, default=None)
+        parser.add_argument("--denoise", action="store_true")
+        parser.add_argument(
+            "--dtype", choices=["float64", "float32", "int16"], default="float64"
+        )
 
         args = parser.parse_args()
+        if "edf_wav_align" in args.steps and args.ref_chan is None:
+            parser.error("--ref_chan is required for the edf_wav_align step")
 
         return args
 
@@ -39,13 +53,23 @@ class Config:
             / "audio/audio-deid/{sid}_Part{part}_audio-deid.wav",
             "audio-transcribe": self.base_path
             / "audio/audio-transcribe/{sid}_Part{part}_audio-transcribe.wav",
+            "audio-timestamps": self.base_path / "audio/{sid}_timestamps.csv",
             "ecog-raw": self.base_path / "ecog/ecog-raw/{sid}_Part{part}_ecog-raw.EDF",
             "ecog-processed": self.base_path
             / "ecog/ecog-processed/{sid}_Part{part}_ecog-processed.EDF",
+            "edf-index": self.base_path / "ecog/{sid}_edf-header-index.json",
+            "channel-qc": self.base_path / "ecog/{sid}_channel-qc.csv",
+            "alignment-cache": self.base_path / "align/{sid}_edf-wav-alignment.json",
+            "time-map": self.base_path / "align/time-map/{edf}_{audio}_time-map.csv",
             "transcript": self.base_path
             / "transcript/xml/{sid}_Part{part}_verbit-transcript.xml",
+            "transcript-part": self.base_path
+            / "transcript/parquet/part={part}/{sid}_Part{part}_transcript.parquet",
             "log": self.base_path / "log/",
             "silence": self.base_path / "notes/deid/{sid}_Part{part}_silences.csv",
+            "silence-vad": self.base_path
+            / "notes/vad/{sid}_Part{part}_silences-vad.csv",
+            "silence-check": self.base_path / "notes/{sid}_silence-check.csv",
             "elec-loc-MNI": (self.base_path / "anat/").glob("*_T1T2_coor_MNI*"),
             "elec-loc-T1": (self.base_path / "anat/").glob("*_T1T2_coor_T1*"),
             "elec-region": (self.base_path / "anat/").glob("*_lh_split_STG_MTG_AnatomicalRegions*"),
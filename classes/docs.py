@@ -130,18 +130,21 @@ class Docs:
                             3,
                             dict(
                                 [
-                                    ("hdr", "Read electrode data from EDF file."),
+                                    (
+                                        "hdr",
+                                        "Read electrode data from EDF file in blocks.",
+                                    ),
                                     (
                                         "desc_txt1",
-                                        "Optionally specify start time, end time, and channels to read",
+                                        "Optionally specify start time, end time, block duration, and channels to read",
                                     ),
                                     ("desc_lnk", ""),
                                     ("desc_lnk_txt", ""),
                                     (
                                         "step_code",
-                                        "ecog_file.read_channels(10, 100000, start=0, end=10)",
+                                        "blocks = ecog_file.read_blocks(10, 10000, block_sec=60)",
                                     ),
-                                    ("class_code", Ecog.read_channels),
+                                    ("class_code", Ecog.read_blocks),
                                 ]
                             ),
                         ),
@@ -149,11 +152,14 @@ class Docs:
                             4,
                             dict(
                                 [
-                                    ("hdr", "TODO"),
+                                    ("hdr", "Process signal data block by block."),
                                     ("desc_txt1", ""),
                                     ("desc_lnk", ""),
                                     ("desc_lnk_txt", ""),
-                                    ("step_code", "ecog_file.process_ecog()"),
+                                    (
+                                        "step_code",
+                                        "blocks = ecog_file.process_ecog(blocks)",
+                                    ),
                                     ("class_code", Ecog.process_ecog),
                                 ]
                             ),
@@ -164,16 +170,19 @@ class Docs:
                                 [
                                     (
                                         "hdr",
-                                        "Name new EDF file according to the 24/7 naming convention [link]",
+                                        "Split EDF file into segments, named according to the 24/7 naming convention [link]",
+                                    ),
+                                    (
+                                        "desc_txt1",
+                                        "Optionally specify segment duration and/or audio part onsets to split at",
                                     ),
-                                    ("desc_txt1", ""),
                                     ("desc_lnk", ""),
                                     ("desc_lnk_txt", ""),
                                     (
                                         "step_code",
-                                        """ecog_file.name = "".join([ecog_file.sid, "_ecog-raw_", "0", ".edf"])""",
+                                        "bounds = ecog_file.segment_bounds(seg_sec, onsets)",
                                     ),
-                                    ("class_code", None),
+                                    ("class_code", Ecog.segment_bounds),
                                 ]
                             ),
                         ),
@@ -181,12 +190,15 @@ class Docs:
                             6,
                             dict(
                                 [
-                                    ("hdr", "Write new EDF file"),
+                                    ("hdr", "Write each segment to a new EDF file"),
                                     ("desc_txt1", ""),
                                     ("desc_lnk", ""),
                                     ("desc_lnk_txt", ""),
-                                    ("step_code", "ecog_file.write_edf()"),
-                                    ("class_code", Ecog.write_edf),
+                                    (
+                                        "step_code",
+                                        "ecog_file.write_segments(blocks, segments)",
+                                    ),
+                                    ("class_code", Ecog.write_segments),
                                 ]
                             ),
                         ),
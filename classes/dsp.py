@@ -0,0 +1,443 @@
+import os
+import numpy as np
+from math import gcd
+from scipy import ndimage, signal
+from concurrent.futures import ThreadPoolExecutor
+from autologging import traced, logged
+
+
+@traced
+@logged
+class FilterChain:
+    """Causal ECoG processing chain applied block by block.
+
+    Every filter carries its state from one block to the next, so processing
+    a file in blocks matches one pass over the whole array to floating-point
+    precision.
+    Channels are split into groups that are filtered in parallel threads.
+
+    ...
+
+    Attributes:
+        samp_rate (int): Sampling rate of the signal.
+        sos (NumPy array): Line-noise notch and bandpass filters, second-order sections.
+        car (bool): Whether to subtract the common average across channels.
+        hg_sos (NumPy array): High-gamma bandpass filter, second-order sections.
+        hilbert (NumPy array): FIR Hilbert transformer taps.
+        chan_groups (:obj:`list` of slice): Channel groups filtered in parallel.
+    """
+
+    def __init__(
+        self,
+        samp_rate,
+        n_chans,
+        line_freq=60,
+        notch_q=30,
+        band=(0.5, 200),
+        order=4,
+        car=False,
+        high_gamma=None,
+        hilbert_taps=129,
+        workers=None,
+        dtype=np.float64,
+    ):
+        """Initializes the filters and their states.
+
+        Args:
+            samp_rate (int): Sampling rate of the signal.
+            n_chans (int): Number of channels in each block.
+            line_freq (float, optional): Line-noise frequency, notched along with
+                its harmonics below Nyquist. None skips the notch.
+            notch_q (float): Quality factor of the notch filters.
+            band (tuple, optional): Bandpass edges in Hz. None skips the bandpass.
+            order (int): Butterworth order of the bandpass filters.
+            car (bool): Subtract the common average across channels.
+            high_gamma (tuple, optional): Band edges in Hz. If given, the output is
+                the envelope of this band, delayed by (hilbert_taps - 1) / 2 samples.
+            hilbert_taps (int): Length of the FIR Hilbert transformer, odd.
+            workers (int, optional): Number of threads, defaults to all cores.
+            dtype (NumPy dtype): Precision of the filters, their states and output.
+        """
+        self.samp_rate = samp_rate
+        self.dtype = np.dtype(dtype)
+        self.car = car
+
+        sections = []
+        if line_freq is not None:
+            for freq in np.arange(line_freq, samp_rate / 2, line_freq):
+                b, a = signal.iirnotch(freq, notch_q, fs=samp_rate)
+                sections.append(signal.tf2sos(b, a))
+        if band is not None:
+            sections.append(
+                signal.butter(order, band, btype="bandpass", output="sos", fs=samp_rate)
+            )
+        self.sos = np.concatenate(sections).astype(dtype) if sections else None
+
+        self.hg_sos = None
+        if high_gamma is not None:
+            self.hg_sos = signal.butter(
+                order, high_gamma, btype="bandpass", output="sos", fs=samp_rate
+            ).astype(dtype)
+            # Windowed ideal Hilbert transformer: 2 / (pi * n) at odd n
+            n = np.arange(hilbert_taps) - hilbert_taps // 2
+            taps = np.zeros(hilbert_taps)
+            taps[n % 2 == 1] = 2 / (np.pi * n[n % 2 == 1])
+            self.hilbert = (taps * np.hamming(hilbert_taps)).astype(dtype)
+
+        workers = workers or os.cpu_count()
+        bounds = np.linspace(0, n_chans, min(workers, n_chans) + 1).astype(int)
+        self.chan_groups = [slice(a, b) for a, b in zip(bounds[:-1], bounds[1:])]
+        self.pool = ThreadPoolExecutor(max_workers=len(self.chan_groups))
+
+        self.reset(n_chans)
+
+    def reset(self, n_chans):
+        """Zero the filter states, as at the start of a file.
+
+        Args:
+            n_chans (int): Number of channels in each block.
+        """
+        if self.sos is not None:
+            self.zi = np.zeros((self.sos.shape[0], n_chans, 2), dtype=self.dtype)
+        if self.hg_sos is not None:
+            self.hg_zi = np.zeros((self.hg_sos.shape[0], n_chans, 2), dtype=self.dtype)
+            self.hilbert_zi = np.zeros(
+                (n_chans, len(self.hilbert) - 1), dtype=self.dtype
+            )
+            # Delay line for the real part, to line up with the Hilbert transform
+            self.delay = np.zeros((n_chans, len(self.hilbert) // 2), dtype=self.dtype)
+
+    def process(self, block):
+        """Run the chain on one block.
+
+        Args:
+            block (NumPy array): (channels x samples) data, following the previous block.
+
+        Returns:
+            NumPy array: (channels x samples) processed data.
+        """
+        block = np.array(block, dtype=self.dtype)
+
+        if self.sos is not None:
+            self._map(self._filter, block)
+        if self.car:
+            block -= block.mean(axis=0)
+        if self.hg_sos is not None:
+            self._map(self._envelope, block)
+
+        return block
+
+    def close(self):
+        """Stop the worker threads."""
+        self.pool.shutdown()
+
+    def _map(self, fun, block):
+        """Apply fun(block, chans) in place to every channel group in parallel."""
+        list(self.pool.map(fun, [block] * len(self.chan_groups), self.chan_groups))
+
+    def _filter(self, block, chans):
+        """Notch and bandpass a channel group."""
+        block[chans], self.zi[:, chans] = signal.sosfilt(
+            self.sos, block[chans], zi=self.zi[:, chans]
+        )
+
+    def _envelope(self, block, chans):
+        """High-gamma envelope of a channel group."""
+        band, self.hg_zi[:, chans] = signal.sosfilt(
+            self.hg_sos, block[chans], zi=self.hg_zi[:, chans]
+        )
+        imag, self.hilbert_zi[chans] = signal.lfilter(
+            self.hilbert, 1, band, zi=self.hilbert_zi[chans]
+        )
+
+        delay = self.delay.shape[1]
+        real = np.concatenate([self.delay[chans], band], axis=1)
+        self.delay[chans] = real[:, real.shape[1] - delay :]
+
+        block[chans] = np.hypot(real[:, : band.shape[1]], imag)
+
+
+@traced
+@logged
+class Resampler:
+    """Rational polyphase resampler applied block by block.
+
+    The output of all blocks plus `flush` matches scipy.signal.resample_poly
+    on the whole signal to floating-point precision, with the same
+    Kaiser-windowed lowpass filter. Only the last few input samples are
+    carried from one block to the next.
+
+    ...
+
+    Attributes:
+        up (int): Upsampling factor.
+        down (int): Downsampling factor.
+        taps (NumPy array): Lowpass filter at the upsampled rate.
+        delay (int): Filter delay at the upsampled rate, compensated in the output.
+    """
+
+    def __init__(self, up, down, window=("kaiser", 5.0)):
+        """Initializes the filter.
+
+        Args:
+            up (int): Upsampling factor.
+            down (int): Downsampling factor.
+            window (str or tuple): Window of the lowpass filter, see scipy.signal.firwin.
+        """
+        factor = gcd(up, down)
+        self.up = up // factor
+        self.down = down // factor
+
+        max_rate = max(self.up, self.down)
+        if max_rate == 1:
+            # Same rate, samples pass through
+            self.delay = 0
+            taps = np.ones(1)
+        else:
+            self.delay = 10 * max_rate
+            taps = signal.firwin(2 * self.delay + 1, 1 / max_rate, window=window)
+            taps *= self.up
+        self.taps = taps
+
+        self.reset()
+
+    def reset(self):
+        """Forget the input, as at the start of a signal."""
+        self.history = None
+        self.n_in = 0
+        self.n_out = 0
+
+    def process(self, block):
+        """Resample one block.
+
+        Args:
+            block (NumPy array): Samples along the first axis, following the
+                previous block.
+
+        Returns:
+            NumPy array: Every output sample that depends only on input so far.
+        """
+        block = np.asarray(block, dtype=np.float64)
+        n_out = -(-((self.n_in + len(block)) * self.up - self.delay) // self.down)
+
+        return self._resample(block, max(n_out, self.n_out))
+
+    def flush(self):
+        """Resample the end of the signal, as if followed by zeros.
+
+        Returns:
+            NumPy array: The remaining output samples. The total output length
+                is ceil(input length * up / down).
+        """
+        if self.history is None:
+            return np.empty(0)
+
+        n_out = -(-self.n_in * self.up // self.down)
+        last_in = ((n_out - 1) * self.down + self.delay) // self.up
+        zeros = np.zeros((max(0, last_in - self.n_in + 1),) + self.history.shape[1:])
+        n_in = self.n_in
+
+        out = self._resample(zeros, n_out)
+        self.n_in = n_in
+
+        return out
+
+    def _resample(self, block, n_out):
+        """Append block to the input and compute outputs up to n_out."""
+        # Inputs each output sample depends on
+        n_hist = -(-len(self.taps) // self.up) - 1
+        if self.history is None:
+            self.history = np.zeros((n_hist,) + block.shape[1:])
+
+        # buffer[j] is input n_in - n_hist + j
+        buffer = np.concatenate([self.history, block])
+        base = self.n_in - n_hist
+        self.n_in += len(block)
+        self.history = buffer[len(buffer) - n_hist :]
+
+        # Output m is the filtered, upsampled input at m * down + delay. Delaying
+        # the taps puts the first one on the grid that upfirdn keeps.
+        first = self.n_out * self.down + self.delay - base * self.up
+        shift = -first % self.down
+        out_start = (first + shift) // self.down
+        out = signal.upfirdn(
+            np.pad(self.taps, (shift, 0)), buffer, self.up, self.down, axis=0
+        )[out_start : out_start + max(0, n_out - self.n_out)]
+        self.n_out = max(self.n_out, n_out)
+
+        return out
+
+
+@traced
+@logged
+class SpectralGate:
+    """Spectral-gating denoiser applied block by block.
+
+    A noise profile (mean and standard deviation of the level of each
+    frequency, per channel) is accumulated from noise-only samples. Each STFT
+    bin of the signal is then kept if it is louder than the noise by n_std
+    standard deviations, and attenuated otherwise. The STFT uses square-root
+    Hann windows at 50% overlap, so the overlap-added output reconstructs the
+    input exactly where nothing is gated. Only half a frame of input and
+    output is carried from one block to the next.
+
+    ...
+
+    Attributes:
+        nperseg (int): STFT frame length, even.
+        hop (int): Samples between frames, half a frame.
+        window (NumPy array): Analysis and synthesis window.
+        n_std (float): Standard deviations above the noise mean that are kept.
+        prop_decrease (float): Proportion by which gated bins are attenuated.
+        freq_smooth (int): Width in bins of the gate smoothing across frequency.
+        noise_sum (NumPy array): Sum of the noise level per bin and channel, in dB.
+        noise_sq_sum (NumPy array): Sum of the squared noise level, in dB.
+        n_noise (int): Number of noise frames summed.
+    """
+
+    def __init__(
+        self, samp_rate, frame_sec=0.064, n_std=1.5, prop_decrease=1.0, freq_smooth=5
+    ):
+        """Initializes the instance, with an empty noise profile.
+
+        Args:
+            samp_rate (int): Sampling rate of the signal.
+            frame_sec (float): Duration of an STFT frame.
+            n_std (float): Standard deviations above the noise mean that are kept.
+            prop_decrease (float): 1 removes gated bins, 0 leaves the signal unchanged.
+            freq_smooth (int): Width in bins of the gate smoothing across frequency.
+        """
+        self.hop = max(1, int(frame_sec * samp_rate / 2))
+        self.nperseg = 2 * self.hop
+        self.window = np.sqrt(signal.get_window("hann", self.nperseg))
+        self.n_std = n_std
+        self.prop_decrease = prop_decrease
+        self.freq_smooth = freq_smooth
+
+        self.noise_sum = 0
+        self.noise_sq_sum = 0
+        self.n_noise = 0
+
+        self.reset()
+
+    def reset(self):
+        """Forget the signal, as at the start of a file. The noise profile is kept."""
+        self.tail = None
+        self.overlap = None
+        self.n_in = 0
+        self.n_out = 0
+
+    def add_noise(self, block):
+        """Add the frames of a noise-only block to the noise profile.
+
+        Args:
+            block (NumPy array): (samples x channels) or mono noise samples.
+        """
+        spectra = self._stft(np.asarray(block, dtype=np.float64))
+        if not len(spectra):
+            return
+
+        level = self._level(spectra)
+        self.noise_sum = self.noise_sum + level.sum(axis=0)
+        self.noise_sq_sum = self.noise_sq_sum + (level**2).sum(axis=0)
+        self.n_noise += len(spectra)
+
+    def threshold(self):
+        """Level above which bins are kept, per frequency and channel, in dB."""
+        if not self.n_noise:
+            raise ValueError("No noise frames were added")
+
+        mean = self.noise_sum / self.n_noise
+        std = np.sqrt(np.maximum(self.noise_sq_sum / self.n_noise - mean**2, 0))
+
+        return mean + self.n_std * std
+
+    def process(self, block):
+        """Denoise one block.
+
+        Args:
+            block (NumPy array): (samples x channels) or mono data, following the
+                last block.
+
+        Returns:
+            NumPy array: Denoised samples whose frames are complete, delayed by
+                up to one frame relative to the input.
+        """
+        block = np.asarray(block, dtype=np.float64)
+        if self.tail is None:
+            # Half a frame of zeros before the start, so every sample is in two frames
+            self.tail = np.zeros((self.hop,) + block.shape[1:])
+            self.overlap = np.zeros((self.hop,) + block.shape[1:])
+            self.skip = self.hop
+            self.threshold_db = self.threshold()
+
+        self.n_in += len(block)
+        buffer = np.concatenate([self.tail, block])
+        spectra = self._stft(buffer)
+        n_frames = len(spectra)
+        self.tail = buffer[n_frames * self.hop :]
+        if not n_frames:
+            return np.empty((0,) + block.shape[1:])
+
+        frames = np.fft.irfft(spectra * self._gain(spectra), self.nperseg, axis=1)
+        frames *= self.window.reshape((-1,) + (1,) * (frames.ndim - 2))
+
+        # Each hop of output is the first half of a frame plus the second half
+        # of the frame before it
+        halves = frames[:, : self.hop] + np.concatenate(
+            [self.overlap[None], frames[:-1, self.hop :]]
+        )
+        self.overlap = frames[-1, self.hop :]
+        out = halves.reshape((-1,) + block.shape[1:])
+
+        skip = min(self.skip, len(out))
+        self.skip -= skip
+        out = out[skip:]
+        self.n_out += len(out)
+
+        return out
+
+    def flush(self):
+        """Denoise the end of the signal, as if followed by zeros.
+
+        Returns:
+            NumPy array: The remaining samples. The total output length equals
+                the input length.
+        """
+        if self.tail is None:
+            return np.empty(0)
+
+        n_in = self.n_in
+        out = self.process(np.zeros((self.nperseg,) + self.tail.shape[1:]))
+        self.n_in = n_in
+
+        return out[: max(0, n_in - (self.n_out - len(out)))]
+
+    def _stft(self, data):
+        """Windowed spectra of the frames every hop, (frames x freqs x channels)."""
+        n_frames = max(0, (len(data) - self.nperseg) // self.hop + 1)
+        if not n_frames:
+            return np.empty((0, self.hop + 1) + data.shape[1:], dtype=complex)
+
+        frames = np.lib.stride_tricks.sliding_window_view(data, self.nperseg, axis=0)[
+            : n_frames * self.hop : self.hop
+        ]
+
+        # sliding_window_view puts the frame axis last
+        frames = np.moveaxis(frames, -1, 1) * self.window.reshape(
+            (-1,) + (1,) * (data.ndim - 1)
+        )
+
+        return np.fft.rfft(frames, axis=1)
+
+    def _level(self, spectra):
+        """Level of each bin in dB."""
+        return 20 * np.log10(np.abs(spectra) + 1e-10)
+
+    def _gain(self, spectra):
+        """Gain of each bin: 1 above the threshold, 1 - prop_decrease below it."""
+        keep = (self._level(spectra) > self.threshold_db).astype(np.float64)
+        if self.freq_smooth > 1:
+            keep = ndimage.uniform_filter1d(keep, self.freq_smooth, axis=1)
+
+        return 1 - self.prop_decrease * (1 - keep)
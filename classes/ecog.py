@@ -3,10 +3,15 @@ import warnings
 import getpass
 import numpy as np
 import datetime as dt
+import mmap
 import multiprocessing
 import pandas as pd
-from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+from copy import deepcopy
 from autologging import traced, logged
+from classes.dsp import FilterChain
+from classes.edf import EdfMap, EdfStreamWriter, signal_scale
 
 
 @traced
@@ -27,23 +32,34 @@ class Ecog:
         non_electrode_id (:obj:`list` of :obj:`str`): Which channel labels are not electrodes.
         expected_sr (int): Expected sampling rate.
         name (str): EDF filename.
+        backend (str): How samples are decoded, 'pyedflib' or 'memmap'.
+        dtype (NumPy dtype): Data type of samples read, float64, float32 or int16.
 
         ecog_hdr (dict): EDF header data.
         samp_rate (int): Sampling rate of electrode channels.
         edf_enddatetime (datetime): End date time of EDF file.
+        chan_nums (:obj:`list` of int): Channels last read.
+        gain (NumPy array): Digital-to-physical gain of each channel read.
+        offset (NumPy array): Digital-to-physical offset of each channel read.
         data (NumPy array): EDF channel data.
     """
 
-    def __init__(self, sid, filename):
+    def __init__(self, sid, filename, backend="pyedflib", dtype="float64"):
         """Initializes the instance based on subject identifier and file identifier.
 
         Args:
           sid (str): Identifies subject.
           file (str): Filename.
+          backend (str): 'pyedflib' reads each channel with EdfReader.readSignal,
+            'memmap' decodes the data records directly (see `EdfMap`).
+          dtype (str): 'float64' or 'float32' physical samples, or 'int16' digital
+            samples with `gain` and `offset` applied lazily (see `physical`).
         """
 
         self.sid = sid
         self.name = filename
+        self.backend = backend
+        self.dtype = np.dtype(dtype)
         self.non_electrode_id = ["SG", "EKG", "DC"]
 
         self.__log.info("User: " + getpass.getuser())
@@ -52,11 +68,19 @@ class Ecog:
 
     # warnings.simplefilter("ignore")
 
-    def read_EDFHeader(self):
-        """Read EDF header."""
-        self.ecog_hdr = pyedflib.highlevel.read_edf_header(
-            str(self.name), read_annotations=True
-        )
+    def read_EDFHeader(self, header_index=None):
+        """Read EDF header.
+
+        Args:
+            header_index (EdfHeaderIndex, optional): Subject header index to query
+                instead of reading the file.
+        """
+        if header_index is not None:
+            self.ecog_hdr = header_index.get(self.name)
+        else:
+            self.ecog_hdr = pyedflib.highlevel.read_edf_header(
+                str(self.name), read_annotations=True
+            )
         self.samp_rate = int(self.ecog_hdr["SignalHeaders"][0]["sample_rate"])
 
     def read_channel_loc(self, filename):
@@ -65,15 +89,17 @@ class Ecog:
         self.channel_locs = channel_locs
 
         return channel_locs
-    
+
     def make_elec_loc_dict():
 
-        keys = ["chan_idx",
-                "elec_name_hdr",
-                "elec_name_txt",
-                "elec_coor_MNI",
-                "elec_coor_T1",
-                "elec_reg"]
+        keys = [
+            "chan_idx",
+            "elec_name_hdr",
+            "elec_name_txt",
+            "elec_coor_MNI",
+            "elec_coor_T1",
+            "elec_reg",
+        ]
 
         return
 
@@ -83,59 +109,312 @@ class Ecog:
         edf_duration = dt.timedelta(seconds=self.ecog_hdr["Duration"])
         self.enddate = self.ecog_hdr["startdate"] + edf_duration
 
-    def read_channels(self, onset_sec, offset_sec, **chan):
-        """Read EDF channels for a certain time frame.
+    def chan_idxs(self, **chan):
+        """Resolve which EDF channels to read, from the header alone.
+
+        The base selection ('chan_list', or 'start'/'end') is narrowed by the
+        optional selectors, keeping header order.
+
+        Args:
+            **chan: Keyword arguments 'start' and/or 'end', or 'chan_list'.
+                Optionally 'groups' (:obj:`list` of :obj:`str`), electrode group
+                prefixes to keep; 'exclude_non_electrode' (bool), drop channels
+                in `non_electrode_id`; 'regions' (:obj:`list` of :obj:`str`),
+                anatomical regions to keep, looked up in `channel_locs`.
+
+        Returns:
+            :obj:`list` of int: Channel indices.
+        """
+        # If channels not specified on function call, read all
+        if "chan_list" in chan:
+            chan_nums = list(chan["chan_list"])
+        else:
+            start = chan.get("start", 0)
+            end = chan.get("end", len(self.ecog_hdr["channels"]))
+            chan_nums = list(range(start, end))
+
+        labels = pd.Series(self.ecog_hdr["channels"])[chan_nums]
+        keep = pd.Series(True, index=labels.index)
+        groups = labels.str.extract(r"([A-Za-z]+)(\d+\.?\d*)")[0]
+
+        if chan.get("groups"):
+            keep &= groups.isin(chan["groups"])
+        if chan.get("exclude_non_electrode"):
+            keep &= ~groups.isin(self.non_electrode_id)
+        if chan.get("regions"):
+            # Primary region of each electrode, from the subject coordinates file
+            in_region = self.channel_locs.region_1.isin(chan["regions"])
+            keep &= labels.isin(self.channel_locs.elec_name_edf[in_region])
+
+        return [idx for idx, kept in zip(chan_nums, keep) if kept]
+
+    def read_blocks(self, onset_sec, offset_sec, block_sec=60, overlap_sec=0, **chan):
+        """Read EDF channels for a certain time frame in fixed-duration blocks.
+
+        Only one block is held in memory at a time. Consecutive blocks share
+        `overlap_sec` seconds of samples, for steps that need context at the
+        block edges.
 
         Args:
             onset_sec (int): Beginning of time frame to read.
             offset_sec (int): End of time frame to read.
-            **chan: Keyword arguments 'start' and/or 'end'.
+            block_sec (int): Duration of each block.
+            overlap_sec (int): Duration shared by consecutive blocks.
+            **chan: Keyword arguments 'start' and/or 'end', or 'chan_list'.
+
+        Returns:
+            generator: Yields (sample offset from `onset_sec`, block) pairs,
+                where each block is a (channels x samples) NumPy array.
         """
+        chan_nums = self.chan_idxs(**chan)
+        self.chan_nums = chan_nums
+        self.calc_scale()
+        onset = int(onset_sec * self.samp_rate)
+        offset = min(
+            int(offset_sec * self.samp_rate),
+            int(self.ecog_hdr["Duration"] * self.samp_rate),
+        )
+        block_len = int(block_sec * self.samp_rate)
+        step = block_len - int(overlap_sec * self.samp_rate)
 
-        def read_elec_signal(chn_idx):
-            return ecog_data.readSignal(chn_idx, onset_sec, offset_sec)
-
-        # If channels not specified on function call, read all 
-        if "chan_list" not in chan:
-            if "start" not in chan:
-                chan["start"] = 0
-            if "end" not in chan:
-                chan["end"] = len(self.ecog_hdr["channels"])
-            chan_nums = range(chan["start"], chan["end"])
-        elif "chan_list" in chan:
-            chan_nums = chan["chan_list"]
-
-        num_samps = offset_sec * self.samp_rate - onset_sec * self.samp_rate
-
-        # TODO: (IMPORTANT) Memory issue with large arrays
-        data = np.empty([len(chan_nums), num_samps])
-
-        ecog_data = pyedflib.EdfReader(str(self.name))
-        # for idx, chan in enumerate(chan_nums):
-        #    # TODO: parallelize
-        # data = ecog_data.readSignal(
-        #        chan,
-        #        onset_sec,
-        #        (offset_sec * self.samp_rate - onset_sec * self.samp_rate),
-        #    )
-        # self.data = data
-        # ecog_data.close()
-
-        with ThreadPoolExecutor() as pool:
-            data = np.stack(list(pool.map(read_elec_signal, chan_nums))).squeeze()
-
-        self.data = data
-        ecog_data.close()
-
-    def process_ecog(self):
-        """Process signal data."""
-        return
+        if step <= 0:
+            raise ValueError("overlap_sec must be shorter than block_sec")
+
+        block_starts = self._block_starts(onset, offset, block_len, step)
+
+        # Capture the file name now, so renaming self.name before iterating is safe
+        if self.backend == "memmap":
+            return self._iter_mmap_blocks(str(self.name), chan_nums, block_starts)
+
+        return self._iter_blocks(str(self.name), chan_nums, block_starts)
+
+    @staticmethod
+    def _block_starts(onset, offset, block_len, step):
+        """First sample, offset from `onset`, and length of each block."""
+        for start in range(onset, offset, step):
+            num_samps = min(block_len, offset - start)
+            yield start, start - onset, num_samps
+
+            if start + num_samps >= offset:
+                break
+
+    def _iter_blocks(self, filename, chan_nums, block_starts):
+        """Read blocks with one pyedflib readSignal call per channel."""
+
+        def read_elec_signal(chn_idx, start, num_samps):
+            return ecog_data.readSignal(chn_idx, start, num_samps, digital=digital)
+
+        digital = self.dtype == np.int16
+
+        ecog_data = pyedflib.EdfReader(filename)
 
-    def write_edf(self):
-        """Write EDF file."""
+        try:
+            with ThreadPoolExecutor() as pool:
+                for start, block_start, num_samps in block_starts:
+                    block = np.empty([len(chan_nums), num_samps], dtype=self.dtype)
 
+                    signals = pool.map(
+                        read_elec_signal,
+                        chan_nums,
+                        repeat(start),
+                        repeat(num_samps),
+                    )
+                    for idx, signal in enumerate(signals):
+                        block[idx] = signal
+
+                    yield block_start, block
+        finally:
+            ecog_data.close()
+
+    def _iter_mmap_blocks(self, filename, chan_nums, block_starts):
+        """Read blocks by decoding memory-mapped EDF data records."""
+        edf_map = EdfMap(filename, self.ecog_hdr["SignalHeaders"])
+
+        for start, block_start, num_samps in block_starts:
+            if self.dtype == np.int16:
+                yield block_start, edf_map.read_digital(chan_nums, start, num_samps)
+            else:
+                yield block_start, edf_map.read(
+                    chan_nums, start, num_samps, dtype=self.dtype
+                )
+
+    def calc_scale(self):
+        """Digital-to-physical gain and offset of the channels read."""
         signal_hdrs = self.ecog_hdr["SignalHeaders"]
-        del self.ecog_hdr["SignalHeaders"]
+        self.gain, self.offset = signal_scale(
+            [signal_hdrs[idx] for idx in self.chan_nums]
+        )
+
+    def physical(self, block):
+        """Physical samples of a block, scaling int16 blocks to float32.
+
+        Args:
+            block (NumPy array): (channels x samples) data of the channels read.
+
+        Returns:
+            NumPy array: Physical data, the block itself if it is not int16.
+        """
+        if not np.issubdtype(block.dtype, np.integer):
+            return block
+
+        data = np.multiply(block, self.gain[:, None], dtype=np.float32)
+        data += self.offset[:, None].astype(np.float32)
+
+        return data
+
+    def read_channels(
+        self, onset_sec, offset_sec, processes=None, chan_slice=16, **chan
+    ):
+        """Read EDF channels for a certain time frame.
+
+        Args:
+            onset_sec (int): Beginning of time frame to read.
+            offset_sec (int): End of time frame to read.
+            processes (int, optional): Read with this many worker processes
+                instead of threads sharing one reader.
+            chan_slice (int): Number of channels each worker process reads per task.
+            **chan: Keyword arguments 'start' and/or 'end', or 'chan_list'.
+        """
+        chan_nums = self.chan_idxs(**chan)
+        self.chan_nums = chan_nums
+        self.calc_scale()
+        onset = int(onset_sec * self.samp_rate)
+        # Clamped to the end of the file, as in read_blocks
+        offset = min(
+            int(offset_sec * self.samp_rate),
+            int(self.ecog_hdr["Duration"] * self.samp_rate),
+        )
+        num_samps = max(0, offset - onset)
+
+        if processes is not None:
+            data = self._read_channels_shared(
+                chan_nums, onset, num_samps, processes, chan_slice
+            )
+            self.data = data.squeeze()
+            return
+
+        # Fill one preallocated array instead of stacking per-channel copies
+        data = np.empty([len(chan_nums), num_samps], dtype=self.dtype)
+        for start, block in self.read_blocks(onset_sec, offset_sec, **chan):
+            data[:, start : start + block.shape[1]] = block
+
+        self.data = data.squeeze()
+
+    def _read_channels_shared(self, chan_nums, onset, num_samps, processes, chan_slice):
+        """Read disjoint slices of channels in worker processes.
+
+        Each worker opens its own EDF reader and writes its channels straight
+        into a shared memory buffer, so no arrays are pickled back. Workers
+        are forked so they inherit the buffer.
+
+        Args:
+            chan_nums (:obj:`list` of int): Channel indices.
+            onset (int): First sample to read.
+            num_samps (int): Number of samples to read.
+            processes (int): Number of worker processes.
+            chan_slice (int): Number of channels per task.
+
+        Returns:
+            NumPy array: (channels x samples) data backed by the shared buffer.
+        """
+        shape = (len(chan_nums), num_samps)
+        buffer = mmap.mmap(-1, max(1, shape[0] * shape[1] * self.dtype.itemsize))
+
+        with ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_read_worker,
+            initargs=(str(self.name), buffer, shape, self.dtype),
+        ) as pool:
+            futures = [
+                pool.submit(
+                    _read_chan_slice,
+                    chan_nums[row : row + chan_slice],
+                    row,
+                    onset,
+                    num_samps,
+                )
+                for row in range(0, len(chan_nums), chan_slice)
+            ]
+            wait(futures)
+
+        # Surface the first worker error, if any
+        for future in futures:
+            future.result()
+
+        return np.frombuffer(
+            buffer, dtype=self.dtype, count=shape[0] * shape[1]
+        ).reshape(shape)
+
+    def process_ecog(self, blocks, **params):
+        """Process signal data block by block.
+
+        Runs a `FilterChain` (line-noise notch, bandpass, optional common
+        average reference and high-gamma envelope) that carries its filter
+        state across blocks. Samples repeated by overlapping blocks are
+        skipped, so the output matches one pass over the whole recording.
+
+        Args:
+            blocks (iterable): (sample offset, block) pairs from `read_blocks`.
+            **params: Keyword arguments passed on to `FilterChain`.
+
+        Returns:
+            generator: Yields (sample offset, processed block) pairs.
+        """
+        # Compact inputs are processed in single precision
+        dtype = np.float64 if self.dtype == np.float64 else np.float32
+        chain = FilterChain(self.samp_rate, len(self.chan_nums), dtype=dtype, **params)
+        samps_done = 0
+
+        try:
+            for start, block in blocks:
+                block = block[:, samps_done - start :]
+                yield samps_done, chain.process(self.physical(block))
+                samps_done += block.shape[1]
+        finally:
+            chain.close()
+
+    def segment_bounds(self, seg_sec=None, onsets=None):
+        """Sample bounds of the segments this file is split into.
+
+        Cuts fall on whole seconds, so every segment is a whole number of
+        one-second data records.
+
+        Args:
+            seg_sec (int, optional): Segment duration in seconds.
+            onsets (:obj:`list` of datetime, optional): Split points, e.g. audio
+                part onsets. Those outside the file are ignored.
+
+        Returns:
+            :obj:`list` of tuple: (onset, offset) sample of each segment.
+        """
+        duration = int(self.ecog_hdr["Duration"])
+        cuts = {0, duration}
+
+        if seg_sec is not None:
+            cuts.update(range(0, duration, seg_sec))
+        for onset in onsets or []:
+            onset_sec = round((onset - self.ecog_hdr["startdate"]).total_seconds())
+            if 0 < onset_sec < duration:
+                cuts.add(onset_sec)
+
+        cuts = [cut * self.samp_rate for cut in sorted(cuts)]
+
+        return list(zip(cuts[:-1], cuts[1:]))
+
+    def edf_headers(self, onset=0, offset=None):
+        """File and signal headers for writing samples onset to offset.
+
+        Args:
+            onset (int): First sample written, shifts the start date and annotations.
+            offset (int, optional): Sample after the last one written.
+
+        Returns:
+            tuple: Signal headers of the channels read, and the file header.
+        """
+        header = deepcopy(self.ecog_hdr)
+        signal_hdrs = header.pop("SignalHeaders")
+        signal_hdrs = [signal_hdrs[idx] for idx in self.chan_nums]
 
         # TODO: move this
         # phys min and max are swapped for some reason (798)
@@ -144,13 +423,108 @@ class Ecog:
                 signal_hdrs[idx]["physical_min"] = -(hdr["physical_min"])
                 signal_hdrs[idx]["physical_max"] = -(hdr["physical_max"])
 
+        onset_sec = onset / self.samp_rate
+        offset_sec = np.inf if offset is None else offset / self.samp_rate
+        header["startdate"] += dt.timedelta(seconds=onset_sec)
+        header["annotations"] = [
+            [start - onset_sec, duration, text]
+            for start, duration, text in header.get("annotations", [])
+            if onset_sec <= start < offset_sec
+        ]
+
+        return signal_hdrs, header
+
+    def write_edf(self, blocks=None):
+        """Write EDF file.
+
+        Blocks are written as they arrive, so a read -> process -> write chain
+        only holds one block at a time.
+
+        Args:
+            blocks (iterable, optional): (sample offset, block) pairs to write
+                instead of `data`.
+        """
+        if blocks is None:
+            blocks = [(0, np.atleast_2d(self.data))]
+
+        # Temp name (?) with datetime
+        self.write_segments(blocks, [(0, None, str(self.name))])
+
+    def write_segments(self, blocks, segments):
+        """Write consecutive segments of a block stream to separate EDF files.
+
+        Each segment is written from views into the incoming blocks, so no
+        samples are copied and only one block is held at a time.
+
+        Args:
+            blocks (iterable): Non-overlapping (sample offset, block) pairs.
+            segments (:obj:`list` of tuple): (onset, offset, filename) of each
+                segment, in order. An offset of None runs to the end of the blocks.
+        """
         # Suppress warnings from edfwriter
         warnings.filterwarnings(
             action="ignore", category=UserWarning, module=r".*edfwriter"
         )
 
-        # Temp name (?) with datetime
-        outname = str(self.name)
-        pyedflib.highlevel.write_edf(
-            outname, self.data, signal_hdrs, header=self.ecog_hdr
+        # Digital blocks are written as is unless the output headers rescale them
+        out_gain, out_offset = signal_scale(self.edf_headers()[0])
+        rescaled = not (
+            np.allclose(out_gain, self.gain) and np.allclose(out_offset, self.offset)
+        )
+
+        segments = iter(segments)
+        onset, offset, outname = next(segments)
+        offset = np.inf if offset is None else offset
+        edf_writer = None
+
+        try:
+            for start, block in blocks:
+                if rescaled:
+                    block = self.physical(block)
+                pos = start
+                end = start + block.shape[1]
+
+                while pos < end and outname is not None:
+                    # Skip samples that fall before the segment
+                    if pos < onset:
+                        pos = min(end, onset)
+                        continue
+
+                    if edf_writer is None:
+                        edf_writer = EdfStreamWriter(
+                            outname, *self.edf_headers(onset, offset)
+                        )
+
+                    stop = min(end, offset)
+                    edf_writer.write_block(
+                        pos - onset, block[:, pos - start : stop - start]
+                    )
+                    pos = stop
+
+                    if pos == offset:
+                        # Let the finally block skip a writer that failed to close
+                        closing, edf_writer = edf_writer, None
+                        closing.close()
+                        onset, offset, outname = next(segments, (None, None, None))
+                        offset = np.inf if offset is None else offset
+        finally:
+            if edf_writer is not None:
+                edf_writer.close()
+
+
+def _init_read_worker(filename, buffer, shape, dtype):
+    """Open one EDF reader per worker process and attach the shared buffer."""
+    global _edf_reader, _shared_data
+
+    _edf_reader = pyedflib.EdfReader(filename)
+    _shared_data = np.frombuffer(
+        buffer, dtype=dtype, count=shape[0] * shape[1]
+    ).reshape(shape)
+
+
+def _read_chan_slice(chan_nums, row, onset, num_samps):
+    """Read a slice of channels into rows of the shared buffer."""
+    for idx, chn_idx in enumerate(chan_nums):
+        _shared_data[row + idx] = _edf_reader.readSignal(
+            chn_idx, onset, num_samps, digital=_shared_data.dtype == np.int16
         )
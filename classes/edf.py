@@ -0,0 +1,427 @@
+import json
+import pyedflib
+import numpy as np
+import datetime as dt
+from copy import deepcopy
+from pathlib import Path
+from autologging import traced, logged
+
+
+def signal_scale(signal_headers):
+    """Digital-to-physical gain and offset of each signal.
+
+    Args:
+        signal_headers (:obj:`list` of dict): pyedflib header of each signal.
+
+    Returns:
+        tuple: gain and offset NumPy arrays, physical = gain * digital + offset.
+    """
+    phys_min, phys_max, dig_min, dig_max = (
+        np.array([hdr[key] for hdr in signal_headers], dtype=float)
+        for key in ["physical_min", "physical_max", "digital_min", "digital_max"]
+    )
+    gain = (phys_max - phys_min) / (dig_max - dig_min)
+
+    return gain, phys_min - gain * dig_min
+
+
+@traced
+@logged
+class EdfMap:
+    """Memory-mapped data records of an EDF file.
+
+    Decodes samples straight from the interleaved data records, so reading
+    any number of channels over a time window is one sequential pass over
+    the file.
+
+    ...
+
+    Attributes:
+        file (str): Path to EDF file.
+        header_bytes (int): Size of the EDF header in bytes.
+        n_records (int): Number of data records.
+        record_sec (float): Duration of one data record in seconds.
+        labels (:obj:`list` of :obj:`str`): Signal labels, without annotation signals.
+        samps_per_record (NumPy array): Samples per data record of each signal.
+        record_idxs (NumPy array): Sample offset of each signal within a data record.
+        gain (NumPy array): Digital-to-physical gain of each signal.
+        offset (NumPy array): Digital-to-physical offset of each signal.
+        records (NumPy memmap): int16 data records, (records x samples per record).
+    """
+
+    annotation_label = "EDF Annotations"
+
+    def __init__(self, file, signal_headers=None):
+        """Initializes the instance by parsing the header and mapping the data records.
+
+        Args:
+            file (str): Path to EDF file.
+            signal_headers (:obj:`list` of dict, optional): Signal headers as read
+                by pyedflib. Used for the digital-to-physical conversion when given.
+        """
+        self.file = str(file)
+        self.read_header()
+
+        if signal_headers is not None:
+            self.calc_gain(signal_headers)
+
+        self.records = np.memmap(
+            self.file,
+            dtype="<i2",
+            mode="r",
+            offset=self.header_bytes,
+            shape=(self.n_records, self.record_len),
+        )
+
+    def read_header(self):
+        """Parse the fixed and per-signal fields of the EDF header."""
+        with open(self.file, "rb") as f:
+            fixed = f.read(256).decode("latin-1")
+            self.header_bytes = int(fixed[184:192])
+            self.n_records = int(fixed[236:244])
+            self.record_sec = float(fixed[244:252])
+            n_signals = int(fixed[252:256])
+            signal = f.read(self.header_bytes - 256).decode("latin-1")
+
+        def field(start, width):
+            return [
+                signal[start + i * width : start + (i + 1) * width].strip()
+                for i in range(n_signals)
+            ]
+
+        # Field widths from the EDF specification, each repeated for every signal
+        widths = [16, 80, 8, 8, 8, 8, 8, 80, 8]
+        starts = np.cumsum([0] + [w * n_signals for w in widths])
+        labels = field(starts[0], 16)
+        phys_min = np.array(field(starts[3], 8), dtype=float)
+        phys_max = np.array(field(starts[4], 8), dtype=float)
+        dig_min = np.array(field(starts[5], 8), dtype=float)
+        dig_max = np.array(field(starts[6], 8), dtype=float)
+        samps_per_record = np.array(field(starts[8], 8), dtype=int)
+
+        # Annotation signals are skipped, matching pyedflib channel numbering
+        signal_idxs = [
+            idx for idx, label in enumerate(labels) if label != self.annotation_label
+        ]
+        self.record_len = samps_per_record.sum()
+        self.labels = [labels[idx] for idx in signal_idxs]
+        self.samps_per_record = samps_per_record[signal_idxs]
+        self.record_idxs = (np.cumsum(samps_per_record) - samps_per_record)[signal_idxs]
+        self.gain = (phys_max - phys_min)[signal_idxs] / (dig_max - dig_min)[
+            signal_idxs
+        ]
+        self.offset = phys_min[signal_idxs] - self.gain * dig_min[signal_idxs]
+
+    def calc_gain(self, signal_headers):
+        """Digital-to-physical gain and offset from pyedflib signal headers.
+
+        Args:
+            signal_headers (:obj:`list` of dict): One header per signal.
+        """
+        self.gain, self.offset = signal_scale(signal_headers)
+
+    def view(self, chan_idxs, records=slice(None)):
+        """Strided (records x channels x samples) view of int16 samples.
+
+        No data is copied when the channels are adjacent in the data record,
+        otherwise only the requested columns are gathered.
+
+        Args:
+            chan_idxs (:obj:`list` of int): Channel indices.
+            records (slice): Data records to include.
+
+        Returns:
+            NumPy array: int16 samples.
+        """
+        chan_idxs = np.asarray(chan_idxs)
+        spr = self.samps_per_record[chan_idxs]
+
+        if np.any(spr != spr[0]):
+            raise ValueError("Channels must share a sampling rate to be read together")
+        spr = spr[0]
+
+        data_records = self.records[records]
+        starts = self.record_idxs[chan_idxs]
+        if np.all(np.diff(starts) == spr):
+            samples = data_records[:, starts[0] : starts[0] + len(starts) * spr]
+        else:
+            samples = data_records[:, (starts[:, None] + np.arange(spr)).ravel()]
+
+        return samples.reshape(len(data_records), len(starts), spr)
+
+    def read_digital(self, chan_idxs, start, num_samps):
+        """Read channels over a time window as raw int16 samples.
+
+        Args:
+            chan_idxs (:obj:`list` of int): Channel indices.
+            start (int): First sample to read.
+            num_samps (int): Number of samples to read.
+
+        Returns:
+            NumPy array: (channels x samples) digital data.
+        """
+        chan_idxs = np.asarray(chan_idxs)
+        spr = self.samps_per_record[chan_idxs[0]]
+        first_rec = start // spr
+        last_rec = -(-(start + num_samps) // spr)
+
+        records = self.view(chan_idxs, slice(first_rec, last_rec))
+        samples = records.transpose(1, 0, 2).reshape(len(chan_idxs), -1)
+        first_samp = start - first_rec * spr
+
+        return samples[:, first_samp : first_samp + num_samps]
+
+    def read(self, chan_idxs, start, num_samps, dtype=np.float64):
+        """Read channels over a time window in physical units.
+
+        Args:
+            chan_idxs (:obj:`list` of int): Channel indices.
+            start (int): First sample to read.
+            num_samps (int): Number of samples to read.
+            dtype (NumPy dtype): Output data type.
+
+        Returns:
+            NumPy array: (channels x samples) physical data.
+        """
+        chan_idxs = np.asarray(chan_idxs)
+        spr = self.samps_per_record[chan_idxs[0]]
+        first_rec = start // spr
+        last_rec = -(-(start + num_samps) // spr)
+
+        # Only the data records covering the window are touched, and they are
+        # converted to physical units in a single pass
+        records = self.view(chan_idxs, slice(first_rec, last_rec))
+        data = np.empty(
+            (len(chan_idxs), records.shape[0], records.shape[2]), dtype=dtype
+        )
+        np.multiply(
+            records.transpose(1, 0, 2), self.gain[chan_idxs, None, None], out=data
+        )
+        data += self.offset[chan_idxs, None, None]
+
+        first_samp = start - first_rec * spr
+
+        return data.reshape(len(chan_idxs), -1)[:, first_samp : first_samp + num_samps]
+
+
+@traced
+@logged
+class EdfStreamWriter:
+    """EDF file written one block of samples at a time.
+
+    The file is opened and the header written once. Blocks are buffered only
+    up to the next data-record boundary, so memory use does not depend on
+    the length of the file.
+
+    ...
+
+    Attributes:
+        file (str): Path to EDF file.
+        samps_per_record (int): Samples per data record of every signal.
+        samps_received (int): Samples per channel passed to `write_block` so far.
+        annotations (list): Annotations written when the file is closed.
+    """
+
+    def __init__(self, file, signal_headers, header):
+        """Initializes the instance by opening the file and writing the header.
+
+        Args:
+            file (str): Path to EDF file.
+            signal_headers (:obj:`list` of dict): One pyedflib header per signal.
+            header (dict): pyedflib file header.
+        """
+        self.file = str(file)
+        self.samps_received = 0
+        self.pending = None
+
+        # Same defaults as pyedflib.highlevel.write_edf
+        file_header = pyedflib.highlevel.make_header()
+        file_header.update(deepcopy(header))
+        self.annotations = file_header.get("annotations", [])
+
+        self.edf_writer = pyedflib.EdfWriter(
+            self.file,
+            n_channels=len(signal_headers),
+            file_type=pyedflib.FILETYPE_EDFPLUS,
+        )
+        self.edf_writer.setSignalHeaders(deepcopy(signal_headers))
+        self.edf_writer.setHeader(file_header)
+
+        samps_per_record = {
+            self.edf_writer.get_smp_per_record(idx)
+            for idx in range(len(signal_headers))
+        }
+        if len(samps_per_record) > 1:
+            self.edf_writer.close()
+            raise ValueError("Signals must share a sampling rate to be streamed")
+        self.samps_per_record = samps_per_record.pop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write_block(self, start, block):
+        """Append a (channels x samples) block of physical or int16 digital samples.
+
+        Samples already received are skipped, so overlapping blocks can be
+        passed as they are.
+
+        Args:
+            start (int): Sample offset of the block from the start of the file.
+            block (NumPy array): (channels x samples) physical data, or digital
+                data if its dtype is integer.
+        """
+        if start > self.samps_received:
+            raise ValueError(
+                f"Gap in blocks: expected sample {self.samps_received}, got {start}"
+            )
+        block = block[:, self.samps_received - start :]
+        self.samps_received += block.shape[1]
+
+        if self.pending is not None:
+            block = np.concatenate([self.pending, block], axis=1)
+
+        n_full = block.shape[1] - block.shape[1] % self.samps_per_record
+        self.write_records(block[:, :n_full])
+        self.pending = block[:, n_full:] if n_full < block.shape[1] else None
+
+    def write_records(self, data):
+        """Write whole data records.
+
+        Args:
+            data (NumPy array): (channels x samples) physical or digital data,
+                a whole number of data records long.
+        """
+        records = data.reshape(data.shape[0], -1, self.samps_per_record)
+
+        if np.issubdtype(data.dtype, np.integer):
+            records = np.ascontiguousarray(records.transpose(1, 0, 2), dtype=np.int16)
+            write_record = self.edf_writer.blockWriteDigitalShortSamples
+        else:
+            records = np.ascontiguousarray(records.transpose(1, 0, 2), dtype=np.float64)
+            write_record = self.edf_writer.blockWritePhysicalSamples
+
+        for record in records:
+            write_record(record.ravel())
+
+    def close(self):
+        """Pad and write the last data record, write annotations and close the file."""
+        if self.pending is not None:
+            last_record = np.zeros(
+                (self.pending.shape[0], self.samps_per_record), dtype=self.pending.dtype
+            )
+            last_record[:, : self.pending.shape[1]] = self.pending
+            self.write_records(last_record)
+            self.pending = None
+
+        for annotation in self.annotations:
+            self.edf_writer.writeAnnotation(*annotation)
+
+        self.edf_writer.close()
+
+
+@traced
+@logged
+class EdfHeaderIndex:
+    """EDF headers of a subject, cached in a JSON file.
+
+    Entries are keyed by path and reused only while the file size and
+    modification time are unchanged, so a changed file is re-read.
+
+    ...
+
+    Attributes:
+        file (PosixPath): Path to the index file.
+        entries (dict): Size, modification time and header of each EDF file.
+    """
+
+    date_keys = ["startdate", "enddate"]
+
+    def __init__(self, file):
+        """Initializes the instance, loading the index file if it exists.
+
+        Args:
+            file (PosixPath): Path to the index file.
+        """
+        self.file = Path(file)
+        self.entries = {}
+        self.changed = False
+
+        if self.file.is_file():
+            self.load()
+
+    def load(self):
+        """Read the index file."""
+        with open(self.file, "r") as f:
+            self.entries = json.load(f)
+
+        for entry in self.entries.values():
+            header = entry["header"]
+            for key in self.date_keys:
+                if header.get(key):
+                    header[key] = dt.datetime.fromisoformat(header[key])
+
+    def save(self):
+        """Write the index file, if any entry was added or updated."""
+        if not self.changed:
+            return
+
+        tmp_file = self.file.with_suffix(".tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(self.entries, f, default=self.to_json)
+        tmp_file.replace(self.file)
+        self.changed = False
+
+    @staticmethod
+    def to_json(value):
+        """JSON form of header values json cannot write (date-times)."""
+        if isinstance(value, (dt.datetime, dt.date)):
+            return value.isoformat()
+        raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+    @staticmethod
+    def annotations(annotations) -> list:
+        """Annotations as [onset, duration, text], durations in seconds or -1.
+
+        pyedflib reads set durations as bytes, which json cannot write.
+        """
+        parsed = []
+        for onset, duration, text in annotations:
+            if isinstance(duration, bytes):
+                duration = float(duration.decode("latin-1") or -1)
+            parsed.append([float(onset), duration, text])
+
+        return parsed
+
+    def get(self, edf_file) -> dict:
+        """Header of an EDF file, read from the file only if not indexed or changed.
+
+        Args:
+            edf_file (PosixPath): Path to EDF file.
+
+        Returns:
+            dict: pyedflib header with annotations, plus end date-time.
+        """
+        edf_file = Path(edf_file).resolve()
+        stat = edf_file.stat()
+        entry = self.entries.get(str(edf_file))
+
+        if (
+            entry is None
+            or entry["size"] != stat.st_size
+            or entry["mtime"] != stat.st_mtime_ns
+        ):
+            header = pyedflib.highlevel.read_edf_header(
+                str(edf_file), read_annotations=True
+            )
+            header["enddate"] = header["startdate"] + dt.timedelta(
+                seconds=header["Duration"]
+            )
+            header["annotations"] = self.annotations(header.get("annotations", []))
+            entry = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "header": header}
+            self.entries[str(edf_file)] = entry
+            self.changed = True
+
+        return deepcopy(entry["header"])
@@ -0,0 +1,184 @@
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from autologging import traced, logged
+
+
+@traced
+@logged
+class PartPool:
+    """Run independent per-part jobs in a process pool under a memory budget.
+
+    A job is only started while the estimated memory of all running jobs
+    stays within the budget, and at least one job always runs. A job that
+    fails is recorded and the others carry on, even if its worker process
+    dies. Without workers, jobs run one by one in this process.
+
+    ...
+
+    Attributes:
+        workers (int): Number of worker processes. None runs jobs in this process.
+        mem_budget (float): Memory budget in bytes. None means no limit.
+        results (dict): Return value of each finished job, keyed by part.
+        errors (dict): Traceback of each failed job, keyed by part.
+        suspects (dict): Number of broken pools each job was running in.
+    """
+
+    def __init__(
+        self, workers=None, mem_budget=None, initializer=None, initargs=(), retries=2
+    ):
+        """Initializes the instance.
+
+        Args:
+            workers (int, optional): Number of worker processes.
+            mem_budget (float, optional): Memory budget in GB.
+            initializer (callable, optional): Called in each worker before any job.
+            initargs (tuple): Arguments for initializer.
+            retries (int): Times a job is rerun after its pool broke.
+        """
+        self.workers = workers
+        self.mem_budget = None if mem_budget is None else mem_budget * 1e9
+        self.initializer = initializer
+        self.initargs = initargs
+        self.retries = retries
+
+    def run(self, fun, jobs):
+        """Run fun on every job.
+
+        Args:
+            fun (callable): Module-level function run for each part.
+            jobs (dict): (args tuple, estimated memory in bytes) for each part.
+
+        Returns:
+            tuple: results and errors dictionaries.
+        """
+        self.results = {}
+        self.errors = {}
+        self.n_jobs = len(jobs)
+
+        if self.workers is None:
+            if self.initializer is not None:
+                self.initializer(*self.initargs)
+            for part, (args, _) in jobs.items():
+                try:
+                    self.finish(part, fun(*args))
+                except Exception:
+                    self.fail(part, traceback.format_exc())
+            return self.results, self.errors
+
+        queue = list(jobs.items())
+        self.suspects = {}
+        while queue:
+            queue = self.run_pool(fun, queue)
+
+        return self.results, self.errors
+
+    def run_pool(self, fun, queue):
+        """Run queued jobs in one process pool, until done or the pool breaks.
+
+        A worker that dies (killed for memory, or crashed) breaks the pool,
+        taking down every job running in it. These jobs go back to the front
+        of the queue and are then run one at a time (see `requeue`).
+
+        Args:
+            fun (callable): Module-level function run for each part.
+            queue (list): (part, (args tuple, estimated memory)) of each job.
+
+        Returns:
+            list: Jobs left to run when the pool broke.
+        """
+        running = {}
+        with ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=self.initializer,
+            initargs=self.initargs,
+        ) as pool:
+            while queue or running:
+                # Start jobs in order while they fit, always keep one running
+                while queue and len(running) < self.workers:
+                    part, (args, mem) = queue[0]
+                    in_use = sum(mem for _, (_, mem) in running.values())
+                    if running and not self.fits(in_use + mem):
+                        break
+                    if running and self.suspect(
+                        [part] + [p for p, _ in running.values()]
+                    ):
+                        break
+                    if not self.fits(mem):
+                        self.__log.warning(f"{part}: estimated memory exceeds budget")
+                    try:
+                        future = pool.submit(fun, *args)
+                    except BrokenProcessPool:
+                        break
+                    running[future] = queue.pop(0)
+
+                if not running:
+                    # The pool broke before any job started in it
+                    part, _ = queue.pop(0)
+                    self.fail(part, "Process pool broken before the job started")
+                    return queue
+
+                broken = []
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    try:
+                        self.finish(job[0], future.result())
+                    except BrokenProcessPool:
+                        broken.append(job)
+                    except Exception:
+                        self.fail(job[0], traceback.format_exc())
+
+                if broken:
+                    return self.requeue(broken + list(running.values())) + queue
+
+        return queue
+
+    def suspect(self, parts):
+        """Whether any of parts was running in a broken pool."""
+        return any(part in self.suspects for part in parts)
+
+    def requeue(self, broken):
+        """Jobs of a broken pool to run again.
+
+        Jobs that were in a broken pool are suspects and run alone, so a
+        suspect that breaks a pool on its own is the one that crashed, and
+        fails. A job also fails once it has been in more than `retries`
+        broken pools.
+
+        Args:
+            broken (list): (part, (args tuple, estimated memory)) of each job
+                running when the pool broke.
+
+        Returns:
+            list: Jobs to run again.
+        """
+        retry = []
+        for part, job in broken:
+            self.suspects[part] = self.suspects.get(part, 0) + 1
+            if len(broken) == 1:
+                self.fail(part, "Worker process died while running this job")
+            elif self.suspects[part] > self.retries:
+                self.fail(part, f"Running in {self.suspects[part]} broken pools")
+            else:
+                retry.append((part, job))
+
+        return retry
+
+    def fits(self, mem):
+        """Whether mem bytes fit in the budget."""
+        return self.mem_budget is None or mem <= self.mem_budget
+
+    def finish(self, part, result):
+        """Record and log a finished job."""
+        self.results[part] = result
+        self.__log.info(f"{part}: done ({self.progress()})")
+
+    def fail(self, part, error):
+        """Record and log a failed job."""
+        self.errors[part] = error
+        self.__log.error(f"{part}: failed ({self.progress()})\n{error}")
+
+    def progress(self):
+        """Number of jobs handled so far, out of all jobs."""
+        return f"{len(self.results) + len(self.errors)}/{self.n_jobs}"
@@ -0,0 +1,190 @@
+import numpy as np
+import pandas as pd
+from scipy import signal
+from autologging import traced, logged
+
+
+@traced
+@logged
+class ChannelStats:
+    """Per-channel quality statistics accumulated over a stream of blocks.
+
+    Every statistic is updated online, so a file is read once, block by block,
+    and the result does not depend on the block size.
+
+    ...
+
+    Attributes:
+        samp_rate (int): Sampling rate of the signal.
+        n_samps (NumPy array): Samples seen per channel.
+        mean (NumPy array): Running mean per channel (Welford).
+        m2 (NumPy array): Running sum of squared deviations per channel (Welford).
+        clip_low (NumPy array): Lower clipping level per channel.
+        clip_high (NumPy array): Upper clipping level per channel.
+        n_clipped (NumPy array): Samples at or beyond a clipping level per channel.
+        min_flat (int): Shortest run of identical samples counted as flatline.
+        max_run (NumPy array): Longest run of identical samples per channel.
+        n_flat (NumPy array): Samples in flatline runs per channel.
+        line_freq (float): Line-noise frequency.
+        freqs (NumPy array): Frequencies of the Welch estimate.
+        psd_sum (NumPy array): Sum of segment periodograms per channel.
+        n_segs (int): Number of Welch segments summed.
+    """
+
+    def __init__(
+        self,
+        samp_rate,
+        phys_min,
+        phys_max,
+        gain=None,
+        line_freq=60,
+        flat_sec=1,
+        nperseg=None,
+    ):
+        """Initializes the accumulators.
+
+        Args:
+            samp_rate (int): Sampling rate of the signal.
+            phys_min (array_like): Physical minimum of each channel.
+            phys_max (array_like): Physical maximum of each channel.
+            gain (array_like, optional): Physical size of one digital step per
+                channel. Samples within half a step of a limit count as clipped.
+            line_freq (float): Line-noise frequency, its power is compared
+                with the total.
+            flat_sec (float): Shortest flatline run counted, in seconds.
+            nperseg (int, optional): Welch segment length, defaults to one second.
+        """
+        phys_min = np.asarray(phys_min, dtype=float)
+        phys_max = np.asarray(phys_max, dtype=float)
+        n_chans = len(phys_min)
+        tol = 0 if gain is None else np.abs(np.asarray(gain, dtype=float)) / 2
+
+        self.samp_rate = samp_rate
+        self.n_samps = np.zeros(n_chans, dtype=np.int64)
+        self.mean = np.zeros(n_chans)
+        self.m2 = np.zeros(n_chans)
+
+        # Some headers have min and max swapped
+        self.clip_low = np.minimum(phys_min, phys_max) + tol
+        self.clip_high = np.maximum(phys_min, phys_max) - tol
+        self.n_clipped = np.zeros(n_chans, dtype=np.int64)
+
+        self.min_flat = int(flat_sec * samp_rate)
+        self.max_run = np.zeros(n_chans, dtype=np.int64)
+        self.n_flat = np.zeros(n_chans, dtype=np.int64)
+        self.last = np.full(n_chans, np.nan)
+        self.run = np.zeros(n_chans, dtype=np.int64)
+
+        self.line_freq = line_freq
+        self.nperseg = nperseg or int(samp_rate)
+        self.step = self.nperseg // 2
+        self.window = signal.get_window("hann", self.nperseg)
+        self.freqs = np.fft.rfftfreq(self.nperseg, 1 / samp_rate)
+        self.psd_sum = np.zeros((n_chans, len(self.freqs)))
+        self.n_segs = 0
+        self.tail = np.empty((n_chans, 0))
+
+    def update(self, block):
+        """Add one block to the statistics.
+
+        Args:
+            block (NumPy array): (channels x samples) physical data, following
+                the previous block.
+        """
+        block = np.asarray(block, dtype=np.float64)
+        if block.shape[1] == 0:
+            return
+
+        self._update_moments(block)
+        self.n_clipped += np.count_nonzero(
+            (block <= self.clip_low[:, None]) | (block >= self.clip_high[:, None]),
+            axis=1,
+        )
+        for chan, samps in enumerate(block):
+            self._update_runs(chan, samps)
+        self._update_psd(block)
+
+    def _update_moments(self, block):
+        """Merge the block mean and sum of squares into the running ones."""
+        n_block = block.shape[1]
+        block_mean = block.mean(axis=1)
+        block_m2 = ((block - block_mean[:, None]) ** 2).sum(axis=1)
+
+        n_total = self.n_samps + n_block
+        delta = block_mean - self.mean
+        self.mean += delta * n_block / n_total
+        self.m2 += block_m2 + delta**2 * self.n_samps * n_block / n_total
+        self.n_samps = n_total
+
+    def _update_runs(self, chan, samps):
+        """Track runs of identical samples of one channel across blocks."""
+        starts = np.flatnonzero(samps[1:] != samps[:-1]) + 1
+        runs = np.diff(np.concatenate([[0], starts, [len(samps)]]))
+
+        # The first run continues the one left open by the previous block
+        if samps[0] == self.last[chan]:
+            runs[0] += self.run[chan]
+        else:
+            self._close_run(chan, self.run[chan])
+
+        closed = runs[:-1]
+        self.n_flat[chan] += closed[closed >= self.min_flat].sum()
+        self.max_run[chan] = max(self.max_run[chan], runs.max())
+        self.run[chan] = runs[-1]
+        self.last[chan] = samps[-1]
+
+    def _close_run(self, chan, run):
+        """Count a finished run of identical samples."""
+        if run >= self.min_flat:
+            self.n_flat[chan] += run
+
+    def _update_psd(self, block):
+        """Add the periodograms of every complete Welch segment."""
+        data = np.concatenate([self.tail, block], axis=1)
+        n_segs = max(0, (data.shape[1] - self.nperseg) // self.step + 1)
+
+        if n_segs:
+            segs = np.lib.stride_tricks.sliding_window_view(data, self.nperseg, axis=1)[
+                :, : n_segs * self.step : self.step
+            ]
+            segs = (segs - segs.mean(axis=2, keepdims=True)) * self.window
+            self.psd_sum += (np.abs(np.fft.rfft(segs, axis=2)) ** 2).sum(axis=1)
+            self.n_segs += n_segs
+
+        self.tail = data[:, n_segs * self.step :]
+
+    def table(self, labels=None):
+        """Statistics of every channel.
+
+        Args:
+            labels (:obj:`list` of str, optional): Channel labels, used as index.
+
+        Returns:
+            DataFrame: One row per channel.
+        """
+        n_samps = np.maximum(self.n_samps, 1)
+        max_run = np.maximum(self.max_run, self.run)
+        n_flat = self.n_flat + np.where(self.run >= self.min_flat, self.run, 0)
+
+        # Line-noise band of +/- 1 Hz against all power above DC
+        line_band = np.abs(self.freqs - self.line_freq) <= 1
+        total = self.psd_sum[:, 1:].sum(axis=1)
+        line_ratio = np.divide(
+            self.psd_sum[:, line_band].sum(axis=1),
+            total,
+            out=np.full(len(total), np.nan),
+            where=total > 0,
+        )
+
+        return pd.DataFrame(
+            {
+                "n_samps": self.n_samps,
+                "mean": self.mean,
+                "std": np.sqrt(self.m2 / n_samps),
+                "clip_frac": self.n_clipped / n_samps,
+                "max_flat_sec": max_run / self.samp_rate,
+                "flat_frac": n_flat / n_samps,
+                "line_ratio": line_ratio,
+            },
+            index=pd.Index(labels, name="channel") if labels is not None else None,
+        )
@@ -6,6 +6,8 @@ import time
 import pandas as pd
 from pathlib import Path
 from autologging import traced, logged, TRACE
+from classes.edf import EdfHeaderIndex
+from classes.cache import ResultCache
 
 # TODO: need more consistency in using path + file name vs. just file name in classes
 
@@ -99,10 +101,41 @@ class Subject:
         ]
         self.silence_files = silence_files
 
+    def edf_header_index(self) -> EdfHeaderIndex:
+        """Returns the subject-level EDF header index."""
+        return EdfHeaderIndex(str(self.filenames["edf-index"]).format(sid=self.sid))
+
+    def alignment_cache(self) -> ResultCache:
+        """Returns the subject-level cache of EDF-WAV alignments."""
+        return ResultCache(str(self.filenames["alignment-cache"]).format(sid=self.sid))
+
+    def audio_onsets(self) -> list:
+        """Returns onset date-time of each audio part, in recording order."""
+        audiotimestamps = pd.read_csv(
+            str(self.filenames["audio-timestamps"]).format(sid=self.sid)
+        )
+
+        # NOTE: 798 has 2 mics, 2 audio files listed (see Transcript.get_audio_info_csv)
+        audiotimestamps = audiotimestamps[0::2]
+        onsets = [
+            pd.Timestamp(" ".join([onset_day, onset_time]))
+            for onset_day, onset_time in zip(
+                audiotimestamps["start date"], audiotimestamps[" start time"]
+            )
+        ]
+
+        return sorted(onsets)
+
     def make_edf_wav_dict(self):
         """Start a dictionary for alignment between EDF and WAV files."""
         self.alignment = {
-            k.name: {"onset": {}, "offset": {}, "audio_files": {}}
+            k.name: {
+                "onset": {},
+                "offset": {},
+                "audio_files": {},
+                "confidence": {},
+                "time_map": {},
+            }
             for k in self.edf_files
         }
 
@@ -119,13 +152,43 @@ class Subject:
             ]
         )
 
+    def read_transcript(self, onset=None, offset=None, columns=None) -> pd.DataFrame:
+        """Read the subject-level transcript from its Parquet dataset.
+
+        Only the parts and row groups that can hold tokens starting within
+        [onset, offset) are read.
+
+        Args:
+            onset (str or Timestamp, optional): Earliest token onset.
+            offset (str or Timestamp, optional): Token onsets before this.
+            columns (list, optional): Columns to read, all by default.
+
+        Returns:
+            DataFrame: Tokens with a part column taken from the partition.
+        """
+        filters = []
+        if onset is not None:
+            filters.append(("onset", ">=", pd.Timestamp(onset)))
+        if offset is not None:
+            filters.append(("onset", "<", pd.Timestamp(offset)))
+
+        return pd.read_parquet(
+            self.filenames["transcript-part"].parents[1],
+            columns=columns,
+            filters=filters or None,
+        )
+
     def create_dir(self):
         """Create directory and standard sub-directories for a new subject."""
         for path in self.filenames:
             if self.filenames[path].suffix:
-                self.filenames[path].parent.mkdir(parents=True, exist_ok=True)
+                directory = self.filenames[path].parent
             elif not self.filenames[path].suffix:
-                self.filenames[path].mkdir(parents=True, exist_ok=True)
+                directory = self.filenames[path]
+            # Templated directories (part={part}) are created when written to
+            while "{" in directory.name:
+                directory = directory.parent
+            directory.mkdir(parents=True, exist_ok=True)
 
     def transfer_files(
         self, filetypes: list = ["ecog", "audio-512Hz", "audio-deid", "silence"]
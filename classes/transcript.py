@@ -1,7 +1,9 @@
 import re
+import numpy as np
 import pandas as pd
 import xml.etree.ElementTree as ET
 from autologging import traced, logged
+from classes.silence import Silence
 
 
 @traced
@@ -15,6 +17,26 @@ class Transcript:
         file (PosixPath): Path to the transcript.
     """
 
+    token_types = ["word", "punctuation", "tag", "silence"]
+
+    # Punctuation we want to split and maintain from tokens
+    punc = "([. |, |! |?])"
+    punc_substrings = {
+        p[i:j] for p in [punc] for i in range(len(p) + 1) for j in range(i, len(p) + 1)
+    }
+    # Joins lines, XML text cannot contain it
+    line_end = "\x1f"
+    # Splits joined lines at line ends, spaces and punctuation
+    split_pattern = re.compile(r"([\x1f .|,!?])")
+    # First '[' of a line and the first ']' after it
+    tag_pattern = re.compile(r"\[[^\]]*\]")
+    # '>>', the elements up to the first one with a ':' and their space, then
+    # the rest of the line
+    header_pattern = re.compile(
+        r"(?s)^(?P<arrow>>>(?= |$)(?: (?:(?P<label>[^:]*:[^ ]*)(?= |$) ?)?)?)?"
+        r"(?P<rest>.*)"
+    )
+
     def __init__(self, sid: str, file):
         """Initializes the instance based on file identifier.
 
@@ -24,95 +46,171 @@ class Transcript:
         self.sid = sid
         self.file = file
 
-    def parse_xml(self):
-        """Convert Verbit.AI format to our format."""
-        # Empty list to append to
-        transcript = []
-        # Increase utterance count for every new utterance
-        utterance_idx = -1
-        # Punctuation we want to split and maintain from tokens
-        punc = "([. |, |! |?])"
-        # get element tree
-        tree = ET.parse(self.file)
-        root = tree.getroot()
+    def parse_xml(self, chunk_lines: int = 50000):
+        """Convert Verbit.AI format to our format.
+
+        The TTML file is parsed incrementally and each line is removed from the
+        tree once its text is read, so memory does not grow with the length of
+        the transcript. Lines are then tokenized chunk_lines at a time (see
+        `tokenize`).
+
+        Args:
+            chunk_lines (int): Number of lines tokenized at once.
+        """
+        ns = "{http://www.w3.org/2006/10/ttaf1}"
+        texts = []
+        onsets = []
+        offsets = []
+        # Open elements, to find the parent of each line
+        parents = []
+        for event, child in ET.iterparse(self.file, events=("start", "end")):
+            if event == "start":
+                parents.append(child)
+                continue
+            parents.pop()
+            if child.tag != ns + "p" or not parents or parents[-1].tag != ns + "div":
+                continue
 
-        # Speaker will be 'Unknown' if the first line doesn't contain a speaker label,
-        # else speaker label is maintained from previous line.
-        speaker = "Unknown"
-        # loop through and index into relevant children
-        for child in root.findall(
-            ".//{http://www.w3.org/2006/10/ttaf1}div/{http://www.w3.org/2006/10/ttaf1}p"
-        ):
             text = child.text
             onset = child.attrib["begin"]
             offset = child.attrib["end"]
+            parents[-1].remove(child)
 
             # This is an empy line. It might be the case that the next line has both words (?)
             if text == None:
                 continue
 
-            if "[" in text:
-                # Remove whitespace inside square brackets so we don't split a single tag
-                start_idx = text.index("[")
-                end_idx = text.index("]") + 1
-                text = (
-                    text[:start_idx]
-                    + text[start_idx:end_idx].replace(" ", "")
-                    + text[end_idx:]
-                )
-
-            # Split if multiple tokens in line
-            line = text.split(" ")
-
-            # '>>' indicates new utterance
-            if line[0] == ">>":
-                utterance_idx += 1
-                del line[0]
-
-                # Update speaker
-                label_break = [idx for idx, s in enumerate(line) if ":" in s]
-                if label_break:
-                    speaker = "".join(line[: label_break[0] + 1]).replace(":", "")
-                    del line[: label_break[0] + 1]
-            for elem in line:
-                # Split if contains punctuation
-                tokens = re.split(punc, elem)
-                for token in tokens:
-                    # Square brackets indicates tag
-                    if "[" in token:
-                        token_type = "tag"
-                    elif token in punc:
-                        token_type = "punctuation"
-                        # TODO: Does the punctuation we want always come at the end of line?
-                        del tokens[-1]
-                    else:
-                        token_type = "word"
-                    # List for this line
-                    line_list = [
-                        token_type,
-                        token,
-                        onset,
-                        offset,
-                        speaker,
-                        utterance_idx,
-                    ]
-                    # Append to full part transcript
-                    transcript.append(line_list)
+            texts.append(text)
+            onsets.append(onset)
+            offsets.append(offset)
 
+        # Speaker will be 'Unknown' if the first line doesn't contain a speaker label,
+        # else speaker label is maintained from previous line.
+        speaker = "Unknown"
+        utterance_idx = -1
+        lines = []
+        tokens = []
+        # An empty transcript is one empty chunk
+        for start in range(0, len(texts), chunk_lines) or [0]:
+            chunk = pd.Series(texts[start : start + chunk_lines], dtype=object)
+            line_chunk, token_chunk = self.tokenize(chunk, speaker, utterance_idx)
+            token_chunk.line += start
+            lines.append(line_chunk)
+            tokens.append(token_chunk)
+            if not line_chunk.empty:
+                speaker = line_chunk.speaker.iloc[-1]
+                utterance_idx = line_chunk.utterance_idx.iloc[-1]
+
+        line = np.concatenate([chunk.line.values for chunk in tokens])
         self.transcript = pd.DataFrame(
-            transcript,
-            columns=[
-                "token_type",
-                "token",
-                "onset",
-                "offset",
-                "speaker",
-                "utterance_idx",
-            ],
+            {
+                "token_type": pd.api.types.union_categoricals(
+                    [chunk.token_type for chunk in tokens]
+                ),
+                "token": np.concatenate([chunk.token.values for chunk in tokens]),
+                "onset": np.array(onsets, dtype=object)[line],
+                "offset": np.array(offsets, dtype=object)[line],
+                "speaker": pd.api.types.union_categoricals(
+                    [chunk.speaker for chunk in lines]
+                ).take(line),
+                "utterance_idx": np.concatenate(
+                    [chunk.utterance_idx.values for chunk in lines]
+                )[line],
+            }
         )
         # TODO: Decide what to do with the 'Multiple Speaker' tag
         # TODO: Checks for additional punctuation: '--'
 
+    @classmethod
+    def tokenize(
+        cls, texts: pd.Series, speaker: str = "Unknown", utterance_idx: int = -1
+    ) -> tuple:
+        """Split transcript lines into tokens, all lines at once.
+
+        A line starting with '>>' begins a new utterance, and a 'Name:' label
+        after it changes the speaker. The rest is split at spaces into
+        elements, and punctuation is split from each element. As before, an
+        element stops one token earlier for every punctuation token in it, so
+        a word followed by punctuation yields the word and the punctuation only.
+
+        Args:
+            texts (Series): Text of each line.
+            speaker (str): Speaker before the first line.
+            utterance_idx (int): Utterance before the first line.
+
+        Returns:
+            tuple: DataFrames of lines (speaker, utterance_idx) and of tokens
+                (line, token, token_type).
+        """
+        texts = texts.reset_index(drop=True)
+
+        # Remove whitespace inside the first square brackets so we don't split a tag
+        has_bracket = texts.str.contains("[", regex=False).values
+        texts[has_bracket] = texts[has_bracket].str.replace(
+            cls.tag_pattern, lambda m: m[0].replace(" ", ""), n=1, regex=True
+        )
+
+        # '>>' indicates new utterance, its label updates the speaker
+        header = texts[texts.str.startswith(">>")].str.extract(cls.header_pattern)
+        labels = header.label.str.replace(" ", "").str.replace(":", "")
+        new_utterance = texts.index.isin(header.index[header.arrow.notna()])
+        # Speaker is maintained from the previous line until the next label
+        lines = pd.DataFrame(
+            {
+                "speaker": pd.Categorical(
+                    labels.reindex(texts.index).ffill().fillna(speaker)
+                ),
+                "utterance_idx": utterance_idx + np.cumsum(new_utterance),
+            }
+        )
+
+        # Tokens follow the header, if it ends in a space
+        rest = texts.copy()
+        rest[header.index] = header.rest
+        rest = rest.drop(header.index[~header.arrow.str.endswith(" ", na=True)])
+
+        # Split all lines at once. Parts alternate between pieces and the
+        # separators, spaces and line ends, found between them.
+        parts = cls.split_pattern.split(cls.line_end.join(rest)) if len(rest) else []
+        parts = np.array(parts, dtype=object)
+        ends_line = parts == cls.line_end
+        ends_elem = ends_line | (parts == " ")
+        line = rest.index.values[np.cumsum(ends_line) - ends_line]
+        elem = np.cumsum(ends_elem)
+        is_piece = np.arange(len(parts)) % 2 == 0
+
+        # Square brackets indicate a tag, other separators are punctuation
+        is_tag = np.zeros(len(parts), dtype=bool)
+        maybe_tag = is_piece & has_bracket[line]
+        is_tag[maybe_tag] = ["[" in piece for piece in parts[maybe_tag]]
+        # Pieces within punc count as punctuation, as `token in punc` did
+        is_punc = ~is_piece
+        is_punc[is_piece] = pd.Series(parts[is_piece]).isin(cls.punc_substrings)
+        is_punc &= ~is_tag
+
+        # Each punctuation token drops one token from the end of its element
+        kept = np.flatnonzero(~ends_elem)
+        elem = elem[kept]
+        elem_start = np.flatnonzero(np.diff(elem, prepend=-1))
+        n_parts = np.diff(elem_start, append=len(elem))
+        elem = np.repeat(np.arange(len(elem_start)), n_parts)
+        pos = np.arange(len(elem)) - elem_start[elem]
+        n_punc = np.cumsum(is_punc[kept]) - is_punc[kept]
+        n_punc -= n_punc[elem_start][elem]
+        emitted = kept[pos + n_punc < n_parts[elem]]
+
+        # Codes of cls.token_types
+        codes = np.where(is_tag, 2, is_punc.astype(np.int8))[emitted]
+        tokens = pd.DataFrame(
+            {
+                "line": line[emitted].astype(np.int64),
+                "token": parts[emitted],
+                "token_type": pd.Categorical.from_codes(codes, cls.token_types),
+            }
+        )
+
+        return lines, tokens
+
     def get_audio_info_csv(self) -> tuple([str, str]):
         """Get audio onset date, time, duration from a CSV file.
 
@@ -133,42 +231,156 @@ class Transcript:
 
         return onset_day, onset_time
 
-    def agg_silences(self, silence_file: pd.DataFrame):
+    def agg_silences(self, silence_file: Silence):
         """Add silence information to transcript.
 
+        Transcript times are on the cropped audio, where the silences were
+        cut out. A word is moved back by the duration of every silence that
+        starts before it (see `silence_shift`), then silences are merged into
+        the transcript by onset.
+
         Args:
-            silence_file (DataFrame): Silence types, onsets, offsets.
+            silence_file (Silence): Silence types, onsets, offsets.
         """
         # TODO: the audio cropping function should match this.
 
         # TODO: speaker and utterance_idx should be inherited where the silence type is not no speech.
         # Re-time transcript to adjust for cropped portions (silences)
-        for onset, offset in zip(
-            silence_file.silence_osnsets, silence_file.silence_offsets
-        ):
-            self.transcript.loc[
-                self.transcript.onset > self.origin + onset, ["onset", "offset"]
-            ] += (offset - onset)
+        word_onsets = (self.transcript.onset - self.origin).values.view(np.int64)
+        shift = self.silence_shift(silence_file, word_onsets).view("m8[ns]")
+        self.transcript.onset += shift
+        self.transcript.offset += shift
 
         # TODO: consider separating retiming and adding silences to transcript for flexibility.
-        rep_val = len(silence_file.silences.silence_type)
+        self.merge_silences(silence_file)
+
+    @staticmethod
+    def silence_shift(silence_file: Silence, times):
+        """Duration of the silences cut out before each time of the cropped audio.
+
+        Each silence onset is moved onto the cropped timeline by subtracting
+        the silences before it, so one search finds the silences before every
+        time.
+
+        Args:
+            silence_file (Silence): Silence onsets and offsets.
+            times (NumPy array): Times on the cropped audio, in int64 nanoseconds.
+
+        Returns:
+            NumPy array: Shift of each time, in int64 nanoseconds.
+        """
+        order = np.argsort(silence_file.silence_onsets.values, kind="stable")
+        onsets = silence_file.silence_onsets.values[order].view(np.int64)
+        offsets = silence_file.silence_offsets.values[order].view(np.int64)
+        shifts = np.concatenate([[0], np.cumsum(offsets - onsets)])
+        # A time after a silence that overlaps the previous one is only past it
+        # once past both
+        cropped_onsets = np.maximum.accumulate(onsets - shifts[:-1])
+
+        return shifts[np.searchsorted(cropped_onsets, times, side="left")]
+
+    def merge_silences(self, silence_file: Silence):
+        """Merge silences into the transcript, which is assumed sorted by onset.
+
+        Silences go after the words that start at the same time.
+
+        Args:
+            silence_file (Silence): Silence types, onsets, offsets.
+        """
+        order = np.argsort(silence_file.silence_onsets.values, kind="stable")
+        rep_val = len(order)
         silence_df = pd.DataFrame(
             {
-                "token_type": ["silence"] * rep_val,
-                "token": silence_file.silences.silence_type,
-                "onset": self.origin + silence_file.silence_onsets,
-                "offset": self.origin + silence_file.silence_offsets,
-                "speaker": [None] * rep_val,
-                "utterance_idx": [None] * rep_val,
+                "token_type": pd.Series(
+                    ["silence"] * rep_val, dtype=self.transcript.token_type.dtype
+                ),
+                "token": silence_file.silences.silence_type.values[order],
+                "onset": self.origin + silence_file.silence_onsets.values[order],
+                "offset": self.origin + silence_file.silence_offsets.values[order],
+                "speaker": pd.Series(
+                    [None] * rep_val, dtype=self.transcript.speaker.dtype
+                ),
+                "utterance_idx": pd.Series([None] * rep_val, dtype="Int64"),
             }
         )
+        transcript = self.transcript.astype({"utterance_idx": "Int64"})
+
+        if not transcript.onset.is_monotonic_increasing:
+            transcript = transcript.sort_values(by="onset", kind="stable")
+        at = np.searchsorted(
+            transcript.onset.values, silence_df.onset.values, side="right"
+        )
+        is_silence = np.zeros(len(transcript) + rep_val, dtype=bool)
+        is_silence[at + np.arange(rep_val)] = True
+        merged = np.empty(len(is_silence), dtype=np.int64)
+        merged[~is_silence] = np.arange(len(transcript))
+        merged[is_silence] = len(transcript) + np.arange(rep_val)
 
         self.transcript = (
-            pd.concat([self.transcript, silence_df])
-            .sort_values(by="onset")
+            pd.concat([transcript, silence_df], ignore_index=True)
+            .take(merged)
             .reset_index(drop=True)
         )
 
+    def retime(
+        self,
+        onset_day: str,
+        onset_time: str,
+        factor: float = 0.05,
+        silence_file: Silence = None,
+    ):
+        """Convert, compress, date and re-time transcript times in one pass.
+
+        Gives the same transcript as convert_timedelta, compress_transcript,
+        add_dt and agg_silences in turn. Onsets and offsets stay int64
+        nanoseconds throughout, each distinct line time is parsed once, and
+        the datetime columns are only written at the end.
+
+        Args:
+            onset_day (str): Date audio file recording begins
+            onset_time (str): Time audio file recording begins
+            factor (float): Factor by which to compress word timings.
+            silence_file (Silence, optional): Silences cut from the audio.
+        """
+        self.origin = pd.Timestamp(" ".join([onset_day, onset_time]))
+
+        times = {}
+        for col in ["onset", "offset"]:
+            codes, uniques = pd.factorize(self.transcript[col])
+            ns = pd.to_timedelta(uniques).values.view(np.int64)[codes]
+            # As compress_transcript: timedelta times a float truncates
+            times[col] = ns - (ns * factor).astype(np.int64)
+
+        shift = 0
+        if silence_file is not None:
+            shift = self.silence_shift(silence_file, times["onset"])
+
+        for col in ["onset", "offset"]:
+            self.transcript[col] = (times[col] + shift + self.origin.value).view(
+                "M8[ns]"
+            )
+
+        if silence_file is not None:
+            self.merge_silences(silence_file)
+
+    def write_parquet(self, file, row_group_size: int = 50000):
+        """Write the transcript as one part of a partitioned Parquet dataset.
+
+        Rows are written in onset order, so readers can skip row groups (and
+        whole parts) outside a time range from their onset statistics.
+
+        Args:
+            file (PosixPath): Path to write, within the part's partition directory.
+            row_group_size (int): Rows per row group.
+        """
+        file.parent.mkdir(parents=True, exist_ok=True)
+        transcript = (
+            self.transcript.rename_axis("part_idx")
+            .reset_index()
+            .sort_values(by=["onset", "part_idx"], kind="stable")
+        )
+        transcript.to_parquet(file, index=False, row_group_size=row_group_size)
+
     def add_dt(self, onset_day: str, onset_time: str):
         """Add audio date-time inofrmation.
 
@@ -0,0 +1,226 @@
+import numpy as np
+import pandas as pd
+from autologging import traced, logged
+from classes.silence import Silence
+
+
+@traced
+@logged
+class Vad:
+    """Energy-based voice activity detection on a streamed WAV file.
+
+    Frame energy and spectral flatness are computed block by block, a whole
+    batch of frames at a time. A frame is speech if it is louder than the
+    noise floor of the file by margin_db and its spectrum is not flat (as it
+    is for broadband noise). Short silences are then bridged and short
+    bursts of speech dropped.
+
+    ...
+
+    Attributes:
+        frame_sec (float): Duration of an analysis frame.
+        margin_db (float): Level above the noise floor counted as speech.
+        floor_pct (float): Percentile of frame energies taken as the noise floor.
+        max_flatness (float): Flattest spectrum counted as speech, 0 to 1.
+        min_silence_sec (float): Shorter silences are bridged.
+        min_speech_sec (float): Shorter speech is dropped.
+        energy_db (NumPy array): Energy of each frame, in dB.
+        flatness (NumPy array): Spectral flatness of each frame.
+        speech (NumPy array): Whether each frame is speech.
+    """
+
+    silence_type = "vad"
+
+    def __init__(
+        self,
+        frame_sec=0.032,
+        margin_db=10,
+        floor_pct=10,
+        max_flatness=0.5,
+        min_silence_sec=0.5,
+        min_speech_sec=0.2,
+    ):
+        """Initializes the detector.
+
+        Args:
+            frame_sec (float): Duration of an analysis frame.
+            margin_db (float): Level above the noise floor counted as speech.
+            floor_pct (float): Percentile of frame energies taken as the noise floor.
+            max_flatness (float): Flattest spectrum counted as speech, 0 to 1.
+            min_silence_sec (float): Shorter silences are bridged.
+            min_speech_sec (float): Shorter speech is dropped.
+        """
+        self.frame_sec = frame_sec
+        self.margin_db = margin_db
+        self.floor_pct = floor_pct
+        self.max_flatness = max_flatness
+        self.min_silence_sec = min_silence_sec
+        self.min_speech_sec = min_speech_sec
+
+    def detect(self, audio_file, block_sec=600):
+        """Find speech frames in a WAV file, reading one block at a time.
+
+        Args:
+            audio_file (Audio): Audio file, read with `Audio.read_blocks`.
+            block_sec (float): Duration of audio held in memory.
+
+        Returns:
+            NumPy array: Whether each frame is speech.
+        """
+        blocks = audio_file.read_blocks(block_sec=block_sec)
+        self.frame_len = max(1, int(self.frame_sec * audio_file.samp_rate))
+        self.frame_rate = audio_file.samp_rate / self.frame_len
+
+        energy_db, flatness = [], []
+        tail = np.empty(0)
+        for _, block in blocks:
+            data = np.concatenate([tail, block])
+            n_frames = len(data) // self.frame_len
+            tail = data[n_frames * self.frame_len :]
+
+            frames = data[: n_frames * self.frame_len].reshape(n_frames, -1)
+            block_db, block_flatness = self.frame_features(frames)
+            energy_db.append(block_db)
+            flatness.append(block_flatness)
+
+        self.energy_db = np.concatenate(energy_db) if energy_db else np.empty(0)
+        self.flatness = np.concatenate(flatness) if flatness else np.empty(0)
+
+        floor_db = (
+            np.percentile(self.energy_db, self.floor_pct) if len(self.energy_db) else 0
+        )
+        speech = (self.energy_db > floor_db + self.margin_db) & (
+            self.flatness < self.max_flatness
+        )
+
+        # Bridge short silences first, so pauses within speech do not split it
+        speech = ~self.drop_short_runs(~speech, self.min_silence_sec)
+        self.speech = self.drop_short_runs(speech, self.min_speech_sec)
+
+        return self.speech
+
+    @staticmethod
+    def frame_features(frames):
+        """Energy in dB and spectral flatness of each frame.
+
+        Args:
+            frames (NumPy array): (frames x samples) audio.
+
+        Returns:
+            tuple: Energy and flatness NumPy arrays, one value per frame.
+        """
+        eps = 1e-12
+        energy_db = 10 * np.log10((frames**2).mean(axis=1) + eps)
+
+        power = np.abs(np.fft.rfft(frames * np.hanning(frames.shape[1]), axis=1)) ** 2
+        power = power[:, 1:] + eps
+        flatness = np.exp(np.log(power).mean(axis=1)) / power.mean(axis=1)
+
+        return energy_db, flatness
+
+    @staticmethod
+    def runs(mask):
+        """First and one-past-last index of each run of True in mask."""
+        bounds = np.flatnonzero(np.diff(np.concatenate([[0], mask, [0]]).astype(int)))
+
+        return bounds[0::2], bounds[1::2]
+
+    @staticmethod
+    def covered(starts, ends, n_frames):
+        """Mask of the frames within any of the intervals."""
+        # Mark where intervals start and end, then count the open ones
+        change = np.zeros(n_frames + 1, dtype=int)
+        np.add.at(change, starts, 1)
+        np.add.at(change, ends, -1)
+
+        return np.cumsum(change)[:-1] > 0
+
+    def drop_short_runs(self, mask, min_sec):
+        """Clear runs of True in mask shorter than min_sec."""
+        starts, ends = self.runs(mask)
+        short = (ends - starts) < min_sec * self.frame_rate
+
+        return mask & ~self.covered(starts[short], ends[short], len(mask))
+
+    def silence_bounds(self):
+        """Onset and offset in seconds of each silence."""
+        starts, ends = self.runs(~self.speech)
+
+        return starts / self.frame_rate, ends / self.frame_rate
+
+    def silences(self):
+        """Detected silences, in the schema of `Silence.silences`.
+
+        Returns:
+            DataFrame: onset_min, onset_sec, offset_min, offset_sec, silence_type.
+        """
+        onsets, offsets = self.silence_bounds()
+
+        return pd.DataFrame(
+            {
+                "onset_min": (onsets // 60).astype(int),
+                "onset_sec": np.round(onsets % 60, 3),
+                "offset_min": (offsets // 60).astype(int),
+                "offset_sec": np.round(offsets % 60, 3),
+                "silence_type": self.silence_type,
+            }
+        )
+
+    def write_silences(self, file):
+        """Write detected silences as a silence file and return it as `Silence`.
+
+        Args:
+            file (PosixPath): Path to write, in the format of the de-id notes.
+
+        Returns:
+            Silence: The written file, read back with its times calculated.
+        """
+        self.silences().to_csv(file, header=False, index=False)
+
+        silence_file = Silence(file)
+        silence_file.read_silence()
+        silence_file.calc_silence()
+
+        return silence_file
+
+    def compare(self, silence_times, min_sec=1.0):
+        """Stretches where detected speech disagrees with a silence file.
+
+        Args:
+            silence_times (Silence): Silences marked by hand, times calculated.
+            min_sec (float): Shortest disagreement reported.
+
+        Returns:
+            DataFrame: onset and offset in seconds and kind of each disagreement,
+                'speech_in_silence' (possible unmarked speech in a silence) or
+                'silence_in_speech' (possible missed silence).
+        """
+        n_frames = len(self.speech)
+        starts, ends = (
+            np.clip(
+                np.rint(times.dt.total_seconds().values * self.frame_rate).astype(int),
+                0,
+                n_frames,
+            )
+            for times in [silence_times.silence_onsets, silence_times.silence_offsets]
+        )
+        marked_silence = self.covered(starts, ends, n_frames)
+
+        diffs = []
+        for kind, mask in [
+            ("speech_in_silence", self.speech & marked_silence),
+            ("silence_in_speech", ~self.speech & ~marked_silence),
+        ]:
+            onsets, offsets = self.runs(mask)
+            long = (offsets - onsets) >= min_sec * self.frame_rate
+            diffs.append(
+                pd.DataFrame(
+                    {
+                        "onset": onsets[long] / self.frame_rate,
+                        "offset": offsets[long] / self.frame_rate,
+                        "kind": kind,
+                    }
+                )
+            )
+
+        return pd.concat(diffs).sort_values("onset").reset_index(drop=True)
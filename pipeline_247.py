@@ -1,6 +1,9 @@
+import os
 import time
 import logging
+import numpy as np
 import pandas as pd
+from pathlib import Path
 from autologging import TRACE
 from string import Template, Formatter
 from classes.subject import Subject
@@ -9,7 +12,10 @@ from classes.ecog import Ecog
 from classes.audio import Audio
 from classes.silence import Silence
 from classes.transcript import Transcript
+from classes.parallel import PartPool
+from classes.edf import EdfHeaderIndex
 from brainmap_new import Plots
+from quality_checks import channel_qc, edf_wav_align, silence_check
 
 def get_silence_times(subject_n, file):
 
@@ -45,69 +51,285 @@ def subject_prep(subject_n: Subject):
     # NOTE: We can get the correct naming when we run downsampling/deid on nyu server
 
 
-def ecog_prep(subject_n: Subject):
-    """Split and process ECoG signal"""
+def ecog_prep_part(
+    sid: str,
+    file,
+    index_file,
+    chan_nums: list,
+    segments: list,
+    block_sec: int = 60,
+    dtype: str = "float64",
+    threads: int = None,
+):
+    """Process one EDF part, streaming blocks from the raw file to its segment files"""
+
+    ecog_file = Ecog(sid, file, backend="memmap", dtype=dtype)
+
+    ecog_file.read_EDFHeader(EdfHeaderIndex(index_file))
+    ecog_file.end_datetime()
+    blocks = ecog_file.read_blocks(
+        0, ecog_file.ecog_hdr["Duration"], block_sec=block_sec, chan_list=chan_nums
+    )
+
+    # Filter state carries across segments, which are views into each block
+    blocks = ecog_file.process_ecog(blocks, workers=threads)
+    ecog_file.write_segments(blocks, segments)
+
+    return [out_file for *_, out_file in segments]
+
+
+def ecog_prep_mem(
+    ecog_hdr: dict, n_chans: int, block_sec: int = 60, dtype: str = "float64"
+) -> float:
+    """Estimate peak memory in bytes of processing one EDF part from its header"""
+
+    # Raw block, plus filtered and record-ordered copies and filter scratch,
+    # which are single precision for compact dtypes
+    raw_bytes = np.dtype(dtype).itemsize
+    work_bytes = 8 if np.dtype(dtype) == np.float64 else 4
+    samp_rate = ecog_hdr["SignalHeaders"][0]["sample_rate"]
+    block_samps = samp_rate * min(block_sec, ecog_hdr["Duration"])
+
+    return (raw_bytes + 3 * work_bytes) * n_chans * block_samps
+
+
+def ecog_prep(
+    subject_n: Subject,
+    workers: int = None,
+    mem_budget: float = None,
+    block_sec: int = 60,
+    seg_sec: int = None,
+    split_audio: bool = False,
+    chan: dict = None,
+    dtype: str = "float64",
+):
+    """Split and process ECoG signal
+
+    Each EDF part is cut into segments of seg_sec seconds and/or at audio part
+    onsets, and every segment is written as its own ecog-processed part.
+
+    Only the channels picked by the chan selector (see Ecog.chan_idxs) are read.
+    They are resolved from each header before any samples are read.
+
+    Parts are independent and run in a PartPool of workers under mem_budget
+    (GB).
 
+    With a dtype of float32 or int16, samples are read and filtered in single
+    precision, which halves or quarters the memory per part.
+    """
+
+    chan = chan or {}
+    ecog_files = {}
+    hdr_errors = {}
+    header_index = subject_n.edf_header_index()
     for file in subject_n.edf_files:
         ecog_file = Ecog(subject_n.sid, file)
+        try:
+            ecog_file.read_EDFHeader(header_index)
+            if chan.get("regions"):
+                ecog_file.read_channel_loc(
+                    str(subject_n.filenames["coor-file"]).format(sid=subject_n.sid)
+                )
+            ecog_file.chan_nums = ecog_file.chan_idxs(**chan)
+        except Exception as e:
+            hdr_errors[file.name] = repr(e)
+            print(f"{file.name}: failed to read header")
+            continue
+        ecog_files[file] = ecog_file
+
+    # Workers read their headers from the saved index
+    header_index.save()
+
+    onsets = subject_n.audio_onsets() if split_audio else None
+
+    # Share the cores between the filter threads of the worker processes
+    threads = max(1, os.cpu_count() // workers) if workers else None
+
+    # Number segments across all parts in recording order
+    jobs = {}
+    part = 0
+    for file, ecog_file in sorted(
+        ecog_files.items(), key=lambda item: item[1].ecog_hdr["startdate"]
+    ):
+        segments = []
+        for onset, offset in ecog_file.segment_bounds(seg_sec, onsets):
+            part += 1
+            out_file = Path(
+                str(subject_n.filenames["ecog-processed"]).format(
+                    sid=subject_n.sid, part=str(part).zfill(3)
+                )
+            )
+            segments.append((onset, offset, out_file))
+
+        jobs[file.name] = (
+            (
+                subject_n.sid,
+                file,
+                header_index.file,
+                ecog_file.chan_nums,
+                segments,
+                block_sec,
+                dtype,
+                threads,
+            ),
+            ecog_prep_mem(
+                ecog_file.ecog_hdr, len(ecog_file.chan_nums), block_sec, dtype
+            ),
+        )
 
-        ecog_file.read_EDFHeader()
-        ecog_file.end_datetime()
-        ecog_file.read_channels(10, 10000)
+    pool = PartPool(workers, mem_budget)
+    _, errors = pool.run(ecog_prep_part, jobs)
 
-        # TODO: Figure out how we're splitting files
-        ecog_file.process_ecog()
-        ecog_file.name = subject_n.rename_files(ecog_file.name, "ecog-processed")
-        ecog_file.write_edf()
+    return {**hdr_errors, **errors}
 
 
-def audio_prep(subject_n: Subject):
-    """Prepare audio file for transcription"""
+# Silence tables of all audio parts, set in each audio_prep worker
+_silence_tables = {}
 
-    for file in subject_n.audio_deid_files:
-        transcribe_audio = Audio(subject_n.sid, file)
 
-        silence_times = get_silence_times(subject_n, file)
-    
-        transcribe_audio.read_audio()
+def init_audio_worker(silence_tables: dict):
+    """Share the parsed silence tables with an audio_prep worker"""
+
+    global _silence_tables
+    _silence_tables = silence_tables
+
+
+def audio_prep_part(
+    sid: str, file, out_name, stream: bool = True, denoise: bool = False
+):
+    """Crop, denoise, slow down and write one audio part for transcription"""
+
+    transcribe_audio = Audio(sid, file)
+    transcribe_audio.out_name = out_name
+    silence_times = _silence_tables[file.name]
+
+    if stream:
+        transcribe_audio.stream_audio(silence_times, denoise=denoise)
+        return out_name
+
+    transcribe_audio.read_audio()
+
+    transcribe_audio.crop_audio(silence_times)
+    if denoise:
+        transcribe_audio.denoise_audio(silence_times)
+    transcribe_audio.slow_audio()
+    transcribe_audio.write_audio()
+
+    return out_name
 
-        transcribe_audio.crop_audio(silence_times)
-        transcribe_audio.slow_audio()
-        # audio.denoise_audio(transcribe_audio)
-        transcribe_audio.out_name = subject_n.rename_files(transcribe_audio.name, "audio-transcribe")
-        transcribe_audio.write_audio()
 
+def audio_prep_mem(audio_file: Audio, stream: bool = True, block_sec: int = 60):
+    """Estimate peak memory in bytes of preparing one audio part"""
 
-def transcript_prep(subject_n: Subject, silence_times: Silence):
-    """Prepare subject-level transcript"""
+    audio_file.read_wav_info()
+    n_samps = audio_file.n_frames * audio_file.n_channels
+    if stream:
+        n_samps = min(n_samps, block_sec * audio_file.samp_rate * audio_file.n_channels)
 
+    # Decoded, resampled and encoded float64 copies
+    return 4 * 8 * n_samps
+
+
+def audio_prep(
+    subject_n: Subject,
+    stream: bool = True,
+    workers: int = None,
+    mem_budget: float = None,
+    denoise: bool = False,
+):
+    """Prepare audio file for transcription
+
+    By default each file is streamed block by block (see Audio.stream_audio),
+    so memory does not grow with its length. stream=False decodes whole files
+    with pydub.
+
+    With denoise, speech is spectrally gated against a noise profile taken
+    from the marked silences (see Audio.noise_gate).
+
+    Silence tables are parsed once and shared with the workers of the
+    PartPool, which runs parts under mem_budget (GB).
+    """
+
+    silence_tables = {}
+    silence_errors = {}
+    jobs = {}
     for file in subject_n.audio_deid_files:
-        transcript_filename = subject_n.rename_files(file, "transcript")
-        # TODO: decide what to do about possible file mismatches (if we have an audio file but no transcript, etc.)
-        if transcript_filename.is_file():
-            transcript_file = Transcript(subject_n.sid, transcript_filename)
+        try:
+            silence_tables[file.name] = get_silence_times(subject_n, file)
+        except Exception as e:
+            silence_errors[file.name] = repr(e)
+            print(f"{file.name}: failed to read silences")
+            continue
+        out_name = subject_n.rename_files(file, "audio-transcribe")
+        jobs[file.name] = (
+            (subject_n.sid, file, out_name, stream, denoise),
+            audio_prep_mem(Audio(subject_n.sid, file), stream),
+        )
+
+    pool = PartPool(
+        workers, mem_budget, initializer=init_audio_worker, initargs=(silence_tables,)
+    )
+    _, errors = pool.run(audio_prep_part, jobs)
+
+    return {**silence_errors, **errors}
 
-            if "silence_times" not in locals():
-                 silence_times = get_silence_times(subject_n, file)
 
-            transcript_prep(transcript_file, silence_times)
+def transcript_prep_part(
+    sid: str, file, silence_times: Silence, out_name, factor: float = 0.05
+):
+    """Parse, re-time and write one part-level transcript"""
 
-        subject_n.transcript = pd.concat(
-            [subject_n.transcript, transcript_file.transcript]
+    transcript_file = Transcript(sid, file)
+    transcript_file.parse_xml()
+
+    onset_day, onset_time = transcript_file.get_audio_info_csv()
+    transcript_file.retime(onset_day, onset_time, factor, silence_times)
+    transcript_file.write_parquet(out_name)
+
+    return transcript_file.transcript
+
+
+def transcript_prep(subject_n: Subject, workers: int = None, mem_budget: float = None):
+    """Prepare subject-level transcript
+
+    Each part is written to the subject's Parquet dataset (partitioned by
+    part) as soon as it is done, see Subject.read_transcript. The parts are
+    then concatenated once into the subject-level transcript. Parts run in a
+    PartPool of workers under mem_budget (GB).
+    """
+
+    errors = {}
+    jobs = {}
+    for file in subject_n.audio_deid_files:
+        transcript_filename = subject_n.rename_files(file, "transcript")
+        # TODO: decide what to do about possible file mismatches (if we have an audio file but no transcript, etc.)
+        if not transcript_filename.is_file():
+            continue
+        try:
+            silence_times = get_silence_times(subject_n, file)
+        except Exception as e:
+            errors[file.name] = repr(e)
+            print(f"{file.name}: failed to read silences")
+            continue
+        out_name = subject_n.rename_files(file, "transcript-part")
+        # Peak of parse_xml is about 20 times the size of the XML file
+        jobs[file.name] = (
+            (subject_n.sid, transcript_filename, silence_times, out_name),
+            20 * transcript_filename.stat().st_size,
         )
-        
-        transcript_file.parse_xml()
-        transcript_file.convert_timedelta()
-        transcript_file.compress_transcript(0.05)
 
-        onset_day, onset_time = transcript_file.get_audio_info_csv()
-        transcript_file.add_dt(onset_day, onset_time)
+    pool = PartPool(workers, mem_budget)
+    results, pool_errors = pool.run(transcript_prep_part, jobs)
+    errors.update(pool_errors)
+
+    parts = [results[part] for part in jobs if part in results]
+    if not parts:
+        return errors
 
-        transcript_file.agg_silences(silence_times)
-    
     # Write subject-level transcript
     subject_n.transcript = (
-        subject_n.transcript.rename_axis("part_idx")
+        pd.concat(parts)
+        .rename_axis("part_idx")
         .sort_values(by=["onset", "part_idx"])
         .reset_index()
     )
@@ -117,6 +339,8 @@ def transcript_prep(subject_n: Subject, silence_times: Silence):
         / "_".join([subject_n.sid, "transcript.csv"])
     )
 
+    return errors
+
 
 def main():
     # Get arguments
@@ -140,12 +364,48 @@ def main():
     subject_n.edf_list()
     subject_n.silence_list()
 
-    fun_list = [subject_prep, ecog_prep, audio_prep, transcript_prep]
+    fun_list = [
+        subject_prep,
+        ecog_prep,
+        channel_qc,
+        edf_wav_align,
+        silence_check,
+        audio_prep,
+        transcript_prep,
+    ]
+    fun_args = {
+        "ecog_prep": dict(
+            workers=args.workers,
+            mem_budget=args.mem_budget,
+            seg_sec=args.seg_sec,
+            split_audio=args.split_audio,
+            chan=dict(
+                groups=args.chan_groups,
+                exclude_non_electrode=args.exclude_non_electrode,
+                regions=args.regions,
+            ),
+            dtype=args.dtype,
+        ),
+        "channel_qc": dict(
+            workers=args.workers, mem_budget=args.mem_budget, dtype=args.dtype
+        ),
+        "silence_check": dict(workers=args.workers, mem_budget=args.mem_budget),
+        "transcript_prep": dict(workers=args.workers, mem_budget=args.mem_budget),
+        "audio_prep": dict(
+            workers=args.workers, mem_budget=args.mem_budget, denoise=args.denoise
+        ),
+        "edf_wav_align": dict(
+            ref_chan=args.ref_chan,
+            workers=args.workers,
+            mem_budget=args.mem_budget,
+            dtype=args.dtype,
+        ),
+    }
 
     for fun in fun_list:
         if fun.__name__ in steps:
             print(fun.__name__ )
-            fun(subject_n)
+            fun(subject_n, **fun_args.get(fun.__name__, {}))
 
     if "save_elec_imgs" in steps:
         outname = ''
@@ -1,23 +1,670 @@
+import re
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy import signal
+import pandas as pd
+import datetime as dt
+from fractions import Fraction
+from pathlib import Path
+from scipy import fft, signal
+from classes.ecog import Ecog
+from classes.audio import Audio
+from classes.edf import EdfHeaderIndex
+from classes.parallel import PartPool
+from classes.qc import ChannelStats
+from classes.silence import Silence
+from classes.vad import Vad
 
 
-def edf_wav_shift(ecog_dict, audio):
-    ecog = signal.decimate(np.array(ecog_dict[204]), 4)
-    correlation = signal.correlate(
-        np.abs(signal.hilbert(ecog)),
-        np.abs(signal.hilbert(audio)),
+def ecog_ref_blocks(ecog_file, ref_chan, onset_sec, offset_sec, block_sec=600):
+    """Physical samples of one reference channel, in 1-D blocks"""
+
+    if isinstance(ref_chan, str):
+        ref_chan = ecog_file.ecog_hdr["channels"].index(ref_chan)
+
+    blocks = ecog_file.read_blocks(
+        onset_sec, offset_sec, block_sec=block_sec, chan_list=[ref_chan]
+    )
+    for start, block in blocks:
+        yield start, ecog_file.physical(block)[0]
+
+
+def stream_envelope(blocks, samp_rate: float, env_rate: float, highpass: float = 10):
+    """Amplitude envelope of a stream of 1-D blocks, sampled at env_rate
+
+    The signal is highpassed, rectified and lowpassed by causal filters whose
+    state carries across blocks, so only one block is held at a time. Both
+    signals of an alignment go through the same filters, so their delays cancel.
+    """
+
+    hp_sos = signal.butter(4, highpass, btype="highpass", output="sos", fs=samp_rate)
+    lp_sos = signal.butter(4, 0.4 * env_rate, output="sos", fs=samp_rate)
+    hp_zi = np.zeros((hp_sos.shape[0], 2))
+    lp_zi = np.zeros((lp_sos.shape[0], 2))
+    step = samp_rate / env_rate
+
+    env = []
+    next_samp = 0
+    for start, block in blocks:
+        block, hp_zi = signal.sosfilt(hp_sos, block, zi=hp_zi)
+        block, lp_zi = signal.sosfilt(lp_sos, np.abs(block), zi=lp_zi)
+
+        # Nearest input sample to each envelope sample falling in this block
+        stop = start + len(block)
+        env_samps = np.arange(next_samp, int(np.ceil(stop / step)) + 1)
+        idxs = np.rint(env_samps * step).astype(int)
+        env_samps, idxs = env_samps[idxs < stop], idxs[idxs < stop]
+        env.append(block[idxs - start])
+        if len(env_samps):
+            next_samp = env_samps[-1] + 1
+
+    return np.concatenate(env) if env else np.empty(0)
+
+
+def sliding_pearson(long, short):
+    """Pearson correlation of short with every window of long of the same length"""
+
+    n = len(short)
+    short = short - short.mean()
+    cov = signal.correlate(long, short, mode="valid", method="fft")
+
+    sums = np.concatenate([[0], np.cumsum(long)])
+    sq_sums = np.concatenate([[0], np.cumsum(long**2)])
+    win_sums = sums[n:] - sums[:-n]
+    win_var = np.maximum(sq_sums[n:] - sq_sums[:-n] - win_sums**2 / n, 0)
+    denom = np.sqrt(win_var * (short**2).sum())
+
+    return np.divide(cov, denom, out=np.zeros_like(cov), where=denom > 0)
+
+
+def edf_wav_shift(
+    ecog_file,
+    audio_file,
+    ref_chan,
+    env_rate: float = 8,
+    refine_sec: float = 60,
+    search_sec: float = None,
+    max_lag_sec: float = None,
+    highpass: float = 10,
+    block_sec: float = 600,
+):
+    """Lag of a WAV file against an EDF reference channel, coarse to fine
+
+    Coarse: envelopes of both whole files are computed block by block at
+    env_rate and cross-correlated, optionally within +/- max_lag_sec.
+    Fine: the lag is refined at the audio sampling rate within +/- search_sec
+    (default two envelope samples), on the loudest refine_sec of audio.
+
+    ecog_file (Ecog, header read) is read through its backend and dtype,
+    audio_file (Audio) through its WAV block reader. ref_chan is the EDF
+    channel index or label that carries the audio.
+
+    Returns (lag_sec, confidence): audio sample 0 lines up with EDF time
+    lag_sec, and confidence is the Pearson correlation of the fine envelopes
+    at that lag.
+    """
+
+    ecog_rate = ecog_file.samp_rate
+    duration = ecog_file.ecog_hdr["Duration"]
+    audio_file.read_wav_info()
+    audio_rate = audio_file.samp_rate
+    search_sec = search_sec or 2 / env_rate
+
+    ecog_env = stream_envelope(
+        ecog_ref_blocks(ecog_file, ref_chan, 0, duration, block_sec),
+        ecog_rate,
+        env_rate,
+        highpass,
+    )
+    audio_env = stream_envelope(
+        audio_file.read_blocks(block_sec=block_sec), audio_rate, env_rate, highpass
+    )
+
+    xcorr = signal.correlate(
+        ecog_env - ecog_env.mean(),
+        audio_env - audio_env.mean(),
         mode="full",
         method="fft",
     )
-    n = len(ecog)
-    # audio = audio[(len(audio)-len(ecog))+(512*60*5):-(512*60*5)]
-    # correlation = signal.correlate(ecog, audio, mode='same') / np.sqrt(signal.correlate(ecog, audio, mode='same')[int(n/2)] * signal.correlate(ecog, audio, mode='same')[int(n/2)])
-    delay_arr = np.linspace(-0.5 * n / 512, 0.5 * n / 512, n)
-    lags = signal.correlation_lags(ecog.size, audio.size, mode="full")
-    lag = lags[np.argmax(correlation)]
-    plt.plot(delay_arr, correlation)
-    plt.savefig("test.png")
+    lags = signal.correlation_lags(len(ecog_env), len(audio_env), mode="full")
+    if max_lag_sec is not None:
+        in_range = np.abs(lags) <= max_lag_sec * env_rate
+        xcorr, lags = xcorr[in_range], lags[in_range]
+    coarse_sec = lags[np.argmax(xcorr)] / env_rate
+
+    # Loudest stretch of audio whose search range lies within the EDF
+    win = int(refine_sec * env_rate)
+    first = max(0, int(np.ceil((search_sec - coarse_sec) * env_rate)))
+    last = (
+        min(len(audio_env), int((duration - search_sec - coarse_sec) * env_rate)) - win
+    )
+    if last < first:
+        raise ValueError("Audio and EDF overlap by less than refine_sec")
+    energy = np.convolve(audio_env[first : last + win], np.ones(win), mode="valid")
+    audio_onset = (first + np.argmax(energy)) / env_rate
+    ecog_onset = audio_onset + coarse_sec - search_sec
+
+    audio_win = np.concatenate(
+        [
+            block
+            for _, block in audio_file.read_blocks(
+                audio_onset, audio_onset + refine_sec, block_sec=refine_sec
+            )
+        ]
+    )
+    ecog_win = np.concatenate(
+        [
+            block
+            for _, block in ecog_ref_blocks(
+                ecog_file,
+                ref_chan,
+                ecog_onset,
+                ecog_onset + refine_sec + 2 * search_sec,
+                refine_sec + 2 * search_sec + 1,
+            )
+        ]
+    )
+
+    # First samples actually read, as the block readers round them
+    audio_start = int(audio_onset * audio_rate) / audio_rate
+    ecog_start = int(ecog_onset * ecog_rate) / ecog_rate
+
+    ratio = Fraction(audio_rate, ecog_rate).limit_denominator(1000)
+    ecog_win = signal.resample_poly(ecog_win, ratio.numerator, ratio.denominator)
+
+    hp_sos = signal.butter(4, highpass, btype="highpass", output="sos", fs=audio_rate)
+    corr = sliding_pearson(
+        np.abs(signal.hilbert(signal.sosfiltfilt(hp_sos, ecog_win))),
+        np.abs(signal.hilbert(signal.sosfiltfilt(hp_sos, audio_win))),
+    )
+    best = np.argmax(corr)
+
+    return ecog_start + best / audio_rate - audio_start, corr[best]
+
+
+def batch_pearson(long, short):
+    """sliding_pearson of each row of short against the same row of long"""
+
+    n = short.shape[1]
+    n_lags = long.shape[1] - n + 1
+    short = short - short.mean(axis=1, keepdims=True)
+
+    # Rows of long are at least as long as the correlation, so nothing wraps
+    nfft = fft.next_fast_len(long.shape[1])
+    cov = fft.irfft(
+        fft.rfft(long, nfft, axis=1) * np.conj(fft.rfft(short, nfft, axis=1)),
+        nfft,
+        axis=1,
+    )[:, :n_lags]
+
+    sums = np.pad(np.cumsum(long, axis=1), ((0, 0), (1, 0)))
+    sq_sums = np.pad(np.cumsum(long**2, axis=1), ((0, 0), (1, 0)))
+    win_sums = sums[:, n:] - sums[:, :-n]
+    win_var = np.maximum(sq_sums[:, n:] - sq_sums[:, :-n] - win_sums**2 / n, 0)
+    denom = np.sqrt(win_var * (short**2).sum(axis=1, keepdims=True))
+
+    return np.divide(cov, denom, out=np.zeros_like(cov), where=denom > 0)
+
+
+def fit_time_map(audio_sec, edf_sec, weights, knots, smooth: float = 1e-3):
+    """Piecewise-linear EDF time of each knot, by weighted least squares
+
+    A small penalty on the change of slope between knots carries the map
+    linearly across knots with no windows.
+    """
+
+    # Hat function of each knot, evaluated at every window
+    basis = np.stack(
+        [np.interp(audio_sec, knots, hat) for hat in np.eye(len(knots))], axis=1
+    )
+    lag = edf_sec - audio_sec
+    slope_change = np.diff(np.eye(len(knots)), 2, axis=0) * np.sqrt(smooth)
+
+    design = np.concatenate([basis * weights[:, None], slope_change])
+    target = np.concatenate([lag * weights, np.zeros(len(slope_change))])
+    knot_lags = np.linalg.lstsq(design, target, rcond=None)[0]
+
+    return knots + knot_lags
+
+
+def edf_wav_drift(
+    ecog_file,
+    audio_file,
+    ref_chan,
+    lag_sec: float,
+    win_sec: float = 30,
+    hop_sec: float = 15,
+    search_sec: float = 1,
+    knot_sec: float = 600,
+    env_rate: float = 64,
+    min_conf: float = 0.3,
+    batch: int = 256,
+    highpass: float = 10,
+    block_sec: float = 600,
+    out_file=None,
+):
+    """Piecewise-linear map from audio time to EDF time, allowing for clock drift
+
+    Starting from the constant lag of edf_wav_shift, the local lag of every
+    win_sec window of audio (every hop_sec) is searched within +/- search_sec.
+    Envelopes are computed once at env_rate, and windows are correlated
+    batch at a time with FFTs along the window axis. Windows with a Pearson
+    correlation of at least min_conf are fit by a piecewise-linear map with
+    knots every knot_sec of audio.
+
+    Returns (time_map, windows): DataFrames of EDF time at each knot of audio
+    time, and of the lag and confidence of each window. With out_file, the
+    time map is also written there as CSV (see read_time_map).
+    """
+
+    ecog_rate = ecog_file.samp_rate
+    duration = ecog_file.ecog_hdr["Duration"]
+    audio_file.read_wav_info()
+
+    ecog_env = stream_envelope(
+        ecog_ref_blocks(ecog_file, ref_chan, 0, duration, block_sec),
+        ecog_rate,
+        env_rate,
+        highpass,
+    )
+    audio_env = stream_envelope(
+        audio_file.read_blocks(block_sec=block_sec),
+        audio_file.samp_rate,
+        env_rate,
+        highpass,
+    )
+
+    win = int(win_sec * env_rate)
+    search = int(search_sec * env_rate)
+    audio_starts = np.arange(0, len(audio_env) - win + 1, int(hop_sec * env_rate))
+    ecog_starts = audio_starts + int(round(lag_sec * env_rate)) - search
+    in_edf = (ecog_starts >= 0) & (ecog_starts + win + 2 * search <= len(ecog_env))
+    audio_starts, ecog_starts = audio_starts[in_edf], ecog_starts[in_edf]
+
+    audio_wins = np.lib.stride_tricks.sliding_window_view(audio_env, win)
+    ecog_wins = np.lib.stride_tricks.sliding_window_view(ecog_env, win + 2 * search)
+    offsets, confs = [], []
+    for idx in range(0, len(audio_starts), batch):
+        corr = batch_pearson(
+            ecog_wins[ecog_starts[idx : idx + batch]],
+            audio_wins[audio_starts[idx : idx + batch]],
+        )
+        best = np.argmax(corr, axis=1)
+
+        # Parabolic interpolation of the peak, between envelope samples
+        rows = np.arange(len(best))
+        left = corr[rows, np.maximum(best - 1, 0)]
+        right = corr[rows, np.minimum(best + 1, corr.shape[1] - 1)]
+        peak = corr[rows, best]
+        curve = left - 2 * peak + right
+        shift = np.divide(
+            left - right, 2 * curve, out=np.zeros_like(peak), where=curve < 0
+        )
+        offsets.append(best + np.clip(shift, -0.5, 0.5))
+        confs.append(peak)
+
+    offsets = np.concatenate(offsets) if offsets else np.empty(0)
+    audio_sec = (audio_starts + win / 2) / env_rate
+    windows = pd.DataFrame(
+        {
+            "audio_sec": audio_sec,
+            "edf_sec": (ecog_starts + offsets + win / 2) / env_rate,
+            "confidence": np.concatenate(confs) if confs else np.empty(0),
+        }
+    )
+
+    good = windows[windows.confidence >= min_conf]
+    if len(good) < 2:
+        raise ValueError("Too few windows correlate to estimate drift")
+
+    audio_dur = audio_file.n_frames / audio_file.samp_rate
+    knots = np.linspace(0, audio_dur, max(2, int(np.ceil(audio_dur / knot_sec)) + 1))
+    edf_knots = fit_time_map(
+        good.audio_sec.values,
+        good.edf_sec.values,
+        good.confidence.values,
+        knots,
+    )
+    time_map = pd.DataFrame(
+        {
+            "edf_file": Path(ecog_file.name).name,
+            "audio_sec": knots,
+            "edf_sec": edf_knots,
+        }
+    )
+
+    if out_file is not None:
+        time_map.to_csv(out_file, index=False)
+
+    return time_map, windows
+
+
+def read_time_map(file) -> pd.DataFrame:
+    """Read a time map written by edf_wav_drift"""
+
+    return pd.read_csv(file)
+
+
+def audio_to_edf(time_map, audio_sec, samp_rate: float = None):
+    """EDF time, or EDF sample index with samp_rate, of audio times
+
+    Times between knots are interpolated linearly. Only the map of one EDF
+    file should be passed.
+    """
+
+    edf_sec = np.interp(audio_sec, time_map.audio_sec, time_map.edf_sec)
+    if samp_rate is None:
+        return edf_sec
+
+    return np.rint(np.asarray(edf_sec) * samp_rate).astype(np.int64)
+
+
+def channel_qc_part(
+    sid: str, file, index_file, block_sec: int = 60, dtype: str = "float64"
+) -> pd.DataFrame:
+    """Channel quality statistics of one EDF part, from a single pass over the file"""
+
+    ecog_file = Ecog(sid, file, backend="memmap", dtype=dtype)
+    ecog_file.read_EDFHeader(EdfHeaderIndex(index_file))
+
+    blocks = ecog_file.read_blocks(
+        0, ecog_file.ecog_hdr["Duration"], block_sec=block_sec
+    )
+    signal_hdrs = [ecog_file.ecog_hdr["SignalHeaders"][i] for i in ecog_file.chan_nums]
+    stats = ChannelStats(
+        ecog_file.samp_rate,
+        [hdr["physical_min"] for hdr in signal_hdrs],
+        [hdr["physical_max"] for hdr in signal_hdrs],
+        gain=ecog_file.gain,
+    )
+    for _, block in blocks:
+        stats.update(ecog_file.physical(block))
+
+    table = stats.table([hdr["label"] for hdr in signal_hdrs])
+    table.insert(0, "file", file.name)
+
+    return table.reset_index()
+
+
+def channel_qc(
+    subject_n,
+    workers: int = None,
+    mem_budget: float = None,
+    block_sec: int = 60,
+    dtype: str = "float64",
+):
+    """Write one table of channel quality statistics for all EDF parts of a subject
+
+    Parts are read in a PartPool of workers under mem_budget (GB).
+    """
+
+    jobs = {}
+    header_index = subject_n.edf_header_index()
+    for file in subject_n.edf_files:
+        ecog_hdr = header_index.get(file)
+        n_chans = len(ecog_hdr["SignalHeaders"])
+        samp_rate = ecog_hdr["SignalHeaders"][0]["sample_rate"]
+        block_samps = samp_rate * min(block_sec, ecog_hdr["Duration"])
+        # Physical block, plus overlapping Welch segments and their spectra
+        mem = 6 * 8 * n_chans * block_samps
+        jobs[file.name] = (
+            (subject_n.sid, file, header_index.file, block_sec, dtype),
+            mem,
+        )
+
+    # Workers read their headers from the saved index
+    header_index.save()
+
+    pool = PartPool(workers, mem_budget)
+    results, errors = pool.run(channel_qc_part, jobs)
+
+    if results:
+        qc_table = pd.concat([results[part] for part in jobs if part in results])
+        qc_table.to_csv(
+            str(subject_n.filenames["channel-qc"]).format(sid=subject_n.sid),
+            index=False,
+        )
+
+    return errors
+
+
+def edf_wav_align_pair(
+    sid: str,
+    edf_file,
+    index_file,
+    audio_file,
+    ref_chan,
+    time_map_file,
+    dtype: str = "float64",
+    min_conf: float = 0.3,
+) -> dict:
+    """Constant lag and drift time map of one EDF-WAV pair"""
+
+    ecog_file = Ecog(sid, edf_file, backend="memmap", dtype=dtype)
+    ecog_file.read_EDFHeader(EdfHeaderIndex(index_file))
+    audio = Audio(sid, audio_file)
+
+    lag_sec, confidence = edf_wav_shift(ecog_file, audio, ref_chan)
+    result = {"lag_sec": lag_sec, "confidence": confidence, "time_map": None}
+    if confidence < min_conf:
+        return result
+
+    audio_dur = audio.n_frames / audio.samp_rate
+    result["onset_sec"] = lag_sec
+    result["offset_sec"] = lag_sec + audio_dur
+    try:
+        time_map, _ = edf_wav_drift(
+            ecog_file, audio, ref_chan, lag_sec, min_conf=min_conf
+        )
+    except ValueError:
+        # Too short an overlap to fit drift, keep the constant lag
+        return result
+
+    Path(time_map_file).parent.mkdir(parents=True, exist_ok=True)
+    time_map.to_csv(time_map_file, index=False)
+    result["time_map"] = str(time_map_file)
+    result["onset_sec"] = float(audio_to_edf(time_map, 0))
+    result["offset_sec"] = float(audio_to_edf(time_map, audio_dur))
+
+    return result
+
+
+def audio_part_onsets(subject_n) -> dict:
+    """Onset date-time of each 512 Hz audio part, keyed by file
+
+    Parts are matched to the recording-ordered onsets by their part number.
+    Raises ValueError unless the parts are numbered 1 to the number of onsets.
+    """
+
+    onsets = subject_n.audio_onsets()
+    parts = {}
+    for file in subject_n.audio_512_files:
+        match = re.search(r"Part(\d+)", file.name)
+        if match is None:
+            raise ValueError(f"{file.name}: no part number in file name")
+        parts[file] = int(match.group(1))
+
+    if sorted(parts.values()) != list(range(1, len(onsets) + 1)):
+        raise ValueError(
+            f"Audio parts {sorted(parts.values())} do not match "
+            f"{len(onsets)} audio onsets"
+        )
+
+    return {
+        file: onsets[part - 1]
+        for file, part in sorted(parts.items(), key=lambda item: item[1])
+    }
+
+
+def edf_wav_align(
+    subject_n,
+    ref_chan,
+    workers: int = None,
+    mem_budget: float = None,
+    slack_sec: float = 600,
+    min_conf: float = 0.3,
+    dtype: str = "float64",
+):
+    """Align every audio part with the EDF files it overlaps, filling subject_n.alignment
+
+    Candidate pairs are audio parts and EDF files whose header date-times
+    overlap within slack_sec. They are aligned in a PartPool of workers under
+    mem_budget (GB). Results are cached by fingerprints of both files and the
+    parameters, so only new or changed pairs are correlated again.
+
+    Pairs with a confidence of at least min_conf are entered in
+    subject_n.alignment[edf name], keyed by audio name: onset and offset are
+    the EDF seconds where the audio starts and ends.
+    """
+
+    if ref_chan is None:
+        raise ValueError("edf_wav_align needs a reference channel (--ref_chan)")
+    if str(ref_chan).isdigit():
+        ref_chan = int(ref_chan)
+
+    header_index = subject_n.edf_header_index()
+    edf_times = {}
+    for file in subject_n.edf_files:
+        ecog_hdr = header_index.get(file)
+        edf_times[file] = (ecog_hdr["startdate"], ecog_hdr["enddate"], ecog_hdr)
+    header_index.save()
+
+    slack = dt.timedelta(seconds=slack_sec)
+    cache = subject_n.alignment_cache()
+    subject_n.make_edf_wav_dict()
+    audio_paths = {file.name: file for file in subject_n.audio_512_files}
+    results = {}
+    keys = {}
+    jobs = {}
+    for audio_file, audio_onset in audio_part_onsets(subject_n).items():
+        audio = Audio(subject_n.sid, audio_file)
+        audio.read_wav_info()
+        audio_offset = audio_onset + dt.timedelta(
+            seconds=audio.n_frames / audio.samp_rate
+        )
+
+        for edf_file, (edf_onset, edf_offset, ecog_hdr) in edf_times.items():
+            if audio_onset - slack >= edf_offset or audio_offset + slack <= edf_onset:
+                continue
+
+            pair = (edf_file.name, audio_file.name)
+            key = cache.fingerprint(
+                [edf_file, audio_file],
+                ref_chan=ref_chan,
+                min_conf=min_conf,
+                dtype=dtype,
+            )
+            result = cache.get(key)
+            if result is not None and (
+                result["time_map"] is None or Path(result["time_map"]).is_file()
+            ):
+                results[pair] = result
+                continue
+
+            time_map_file = str(subject_n.filenames["time-map"]).format(
+                edf=edf_file.stem, audio=audio_file.stem
+            )
+            samp_rate = ecog_hdr["SignalHeaders"][0]["sample_rate"]
+            # Reference and audio blocks, with filter and envelope copies
+            mem = 4 * 8 * 600 * (samp_rate + audio.samp_rate)
+            jobs[pair] = (
+                (
+                    subject_n.sid,
+                    edf_file,
+                    header_index.file,
+                    audio_file,
+                    ref_chan,
+                    time_map_file,
+                    dtype,
+                    min_conf,
+                ),
+                mem,
+            )
+            keys[pair] = key
+
+    pool = PartPool(workers, mem_budget)
+    new_results, errors = pool.run(edf_wav_align_pair, jobs)
+    for pair, result in new_results.items():
+        cache.put(keys[pair], result)
+        results[pair] = result
+    cache.save()
+
+    for (edf_name, audio_name), result in results.items():
+        if result["confidence"] < min_conf:
+            continue
+        alignment = subject_n.alignment[edf_name]
+        alignment["onset"][audio_name] = result["onset_sec"]
+        alignment["offset"][audio_name] = result["offset_sec"]
+        alignment["audio_files"][audio_name] = str(audio_paths[audio_name])
+        alignment["confidence"][audio_name] = result["confidence"]
+        alignment["time_map"][audio_name] = result["time_map"]
+
+    return errors
+
+
+def silence_check_part(
+    sid: str, file, vad_file, silence_file=None, block_sec: int = 600
+) -> pd.DataFrame:
+    """Detect silences in one audio part and diff them against its silence file"""
+
+    audio_file = Audio(sid, file)
+    audio_file.read_wav_info()
+
+    vad = Vad()
+    vad.detect(audio_file, block_sec=block_sec)
+    Path(vad_file).parent.mkdir(parents=True, exist_ok=True)
+    vad.write_silences(vad_file)
+
+    if silence_file is None:
+        return None
+
+    silence_times = Silence(silence_file)
+    silence_times.read_silence()
+    silence_times.calc_silence()
+
+    diffs = vad.compare(silence_times)
+    diffs.insert(0, "file", file.name)
+
+    return diffs
+
+
+def silence_check(
+    subject_n, workers: int = None, mem_budget: float = None, block_sec: int = 600
+):
+    """Write VAD silence files for all audio parts and flag where they disagree
+
+    Every de-identified audio part gets a silence file from energy-based voice
+    activity detection (see Vad). Where a hand-marked silence file exists,
+    stretches of detected speech inside marked silences, and of detected
+    silence outside them, are collected in one table for review. Parts run in
+    a PartPool of workers under mem_budget (GB).
+    """
+
+    jobs = {}
+    for file in subject_n.audio_deid_files:
+        silence_file = subject_n.rename_files(file, "silence")
+        vad_file = subject_n.rename_files(file, "silence-vad")
+        audio_file = Audio(subject_n.sid, file)
+        audio_file.read_wav_info()
+        # Decoded block, its float copy and the framed spectra
+        mem = 4 * 8 * audio_file.n_channels * audio_file.samp_rate * block_sec
+        jobs[file.name] = (
+            (
+                subject_n.sid,
+                file,
+                vad_file,
+                silence_file if silence_file.is_file() else None,
+                block_sec,
+            ),
+            mem,
+        )
+
+    pool = PartPool(workers, mem_budget)
+    results, errors = pool.run(silence_check_part, jobs)
+
+    diffs = [results[part] for part in jobs if results.get(part) is not None]
+    if diffs:
+        pd.concat(diffs).to_csv(
+            str(subject_n.filenames["silence-check"]).format(sid=subject_n.sid),
+            index=False,
+        )
 
-    return
+    return errors
@@ -0,0 +1,27 @@
+import numpy as np
+from classes.dsp import SpectralGate
+
+
+def denoise(data, noise, block_len=1000):
+    """Denoise data block by block with a gate fit on noise."""
+    gate = SpectralGate(8000)
+    gate.add_noise(noise)
+    out = [
+        gate.process(data[i : i + block_len]) for i in range(0, len(data), block_len)
+    ]
+    out.append(gate.flush())
+
+    return np.concatenate(out)
+
+
+def test_spectral_gate_mono():
+    rng = np.random.default_rng(0)
+    noise = 0.1 * rng.standard_normal(8000)
+    tone = np.sin(2 * np.pi * 440 * np.arange(8000) / 8000)
+    data = tone + 0.1 * rng.standard_normal(8000)
+
+    mono = denoise(data, noise)
+    channels = denoise(data[:, None], noise[:, None])
+
+    assert mono.shape == data.shape
+    np.testing.assert_allclose(mono, channels[:, 0])